@@ -0,0 +1,72 @@
+"""Bitboards: sets of squares stored in the bits of an integer."""
+
+from array import array
+
+# Square s = 8 * x + y of the board is stored in bit s
+
+# Elementary steps of the pieces
+straight_steps = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+diagonal_steps = [(1, 1), (-1, 1), (-1, -1), (1, -1)]
+knight_steps = [
+    (1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)
+]
+
+
+def square_mask(x, y):
+    """Bitboard of a single square."""
+    return 1 << (8 * x + y)
+
+
+def empty_bitboards(n):
+    """Array of n empty bitboards, 8 bytes each."""
+    return array("Q", bytes(8 * n))
+
+
+def build_rays(step):
+    """List the squares met when repeating a step from each square."""
+    h, v = step
+    rays = []
+    for s in range(64):
+        x, y = s // 8 + h, s % 8 + v
+        ray = []
+        while 0 <= x < 8 and 0 <= y < 8:
+            ray.append(square_mask(x, y))
+            x, y = x + h, y + v
+        rays.append(tuple(ray))
+    return rays
+
+
+def build_leaps(steps):
+    """Compute the bitboard reached in one of the steps from each square."""
+    leaps = []
+    for s in range(64):
+        mask = 0
+        for (h, v) in steps:
+            x, y = s // 8 + h, s % 8 + v
+            if 0 <= x < 8 and 0 <= y < 8:
+                mask |= square_mask(x, y)
+        leaps.append(mask)
+    return leaps
+
+
+rays = {
+    step: build_rays(step)
+    for step in straight_steps + diagonal_steps
+}
+king_leaps = build_leaps(straight_steps + diagonal_steps)
+knight_leaps = build_leaps(knight_steps)
+pawn_captures = [
+    build_leaps([(-1, 1), (1, 1)]),
+    build_leaps([(-1, -1), (1, -1)])
+]
+
+
+def slide(s, steps, occupied):
+    """Compute the bitboard attacked from s along rays, up to the blockers."""
+    mask = 0
+    for step in steps:
+        for square in rays[step][s]:
+            mask |= square
+            if square & occupied:
+                break
+    return mask
@@ -1,11 +1,19 @@
 """First test for chess implementation."""
 
-import itertools
+import sys
 import numpy as np
-import pulp
 from collections import defaultdict
 
 import sunfish
+import parallel
+from bitboards import (
+    straight_steps, diagonal_steps, knight_steps, square_mask,
+    empty_bitboards, king_leaps, knight_leaps, pawn_captures, slide
+)
+from consistency import (
+    Forbidden, Count, NoCheck, Check, FEASIBLE, CachedModel, backends,
+    feasibility_cache
+)
 
 colors = list(range(2))
 piece_numbers = list(range(16))
@@ -13,6 +21,9 @@ major_piece_numbers = list(range(8))
 pawn_numbers = list(range(8, 16))
 promoted_numbers = list(range(16, 24))
 
+# Nature assignments the auto-move searches by default
+auto_move_samples = 4
+
 all_natures = ["K", "Q", "R", "B", "N", "P"]
 major_piece_natures = ["K", "Q", "R", "B", "N"]
 
@@ -24,6 +35,39 @@ max_quantity = {
     "N": 2
 }
 
+# Elementary steps of each nature, and whether they can be repeated
+nature_steps = {
+    "K": (straight_steps + diagonal_steps, False),
+    "Q": (straight_steps + diagonal_steps, True),
+    "R": (straight_steps, True),
+    "B": (diagonal_steps, True),
+    "N": (knight_steps, False)
+}
+nature_leaps = {"K": king_leaps, "N": knight_leaps}
+
+# Bitboards of the history are stored in flat arrays, one per piece for
+# positions and one per piece and nature for attacks, pawn captures last
+pawn_attack = len(major_piece_natures)
+
+
+def nature_attack(n, s, occupied):
+    """Compute the bitboard attacked by nature n from square s."""
+    steps, repeat = nature_steps[n]
+    if repeat:
+        return slide(s, steps, occupied)
+    return nature_leaps[n][s]
+
+
+def piece_slot(c, i):
+    """Index of piece (c, i) in a position array."""
+    return 24 * c + i
+
+
+def attack_slot(c, i, n_ind):
+    """Index of piece (c, i) with nature index n_ind in an attack array."""
+    return 6 * (24 * c + i) + n_ind
+
+
 color_nature_to_icon = {
     0: {
         "K": "♔",
@@ -108,8 +152,25 @@ class ChessPiece():
 class ChessBoard():
     """Chess board manipulation."""
 
-    def __init__(self):
-        """Initialize the board."""
+    def __init__(
+        self, backend="pulp", cache=feasibility_cache, debug=False,
+        memory_cap=None, workers=None
+    ):
+        """
+        Initialize the board.
+
+        The backend is the name of the consistency model used to explain
+        the history, either "pulp" (MIP) or "propagation" (in-process).
+        Answers are memoized in the cache, shared by default with every
+        other board of the process (None disables it).
+        In debug mode, the attacks updated after each move are checked
+        against a full recomputation.
+        The history keeps a compact record of the threatened pieces of each
+        ply. The full bitboards of past plies are dropped once they exceed
+        memory_cap bytes (None keeps them all).
+        With workers, moves and natures are checked in a pool of that many
+        processes (0 for one per core) instead of one after the other.
+        """
         # Colorized lists of pieces
         white_pieces = [
             ChessPiece(c=0, i=i, n=None, p=(i, 0), b=self)
@@ -149,8 +210,33 @@ class ChessBoard():
         self.nature_eliminations = []
         self.positions = [self.compute_position()]
         self.attacks = [self.compute_attack()]
+        self.threats = [
+            self.compute_threats(self.positions[0], self.attacks[0])]
+        self.memory_cap = memory_cap
         self.pieces_alive = [[16, 16]]
 
+        # Consistency model, updated along with the history
+        self.backend = backend
+        self.cache = cache
+        domains, rules = self.domains(), self.rule_constraints()
+        self.rules = rules
+        # Constraints of the rules, then of each move, compiled only once
+        self.constraints = [rules]
+        self.model = backends[backend](domains, rules)
+        if cache is not None:
+            self.model = CachedModel(self.model, rules, cache)
+
+        self.debug = debug
+        # End of game verdict, with the history it was given for
+        self.verdict = None
+        # Sunfish searcher of the auto-moves, whose tables are reused
+        self.searcher = None
+        # Last unseeded move suggestions, with the history and budget
+        self.suggestions = None
+        self.pool = None
+        if workers is not None:
+            self.pool = parallel.LegalityPool(self, workers)
+
     def __str__(self, guess=False, natures=False, letters=True):
         """Display the board in ASCII art."""
         s = "\n"
@@ -350,221 +436,236 @@ class ChessBoard():
         return (piece.color, piece.number, move_forbidden_natures)
 
     def compute_position(self):
-        """Encode position as a binary table."""
-        position = np.zeros((64, 2, 24))
+        """Encode position as one bitboard per piece."""
+        position = empty_bitboards(48)
         for x in range(8):
             for y in range(8):
                 piece = self.grid[x][y]
                 if piece is None:
                     continue
-                s = self.get_square(x, y)
                 c, i = piece.color, piece.number
-                position[(s, c, i)] = 1
+                position[piece_slot(c, i)] = square_mask(x, y)
         return position
 
+    def compute_natures(self):
+        """Encode the possible natures of each piece as bitmasks."""
+        natures = bytearray(48)
+        for c in colors:
+            for piece in self.pieces[c]:
+                for n in piece.possible_natures:
+                    natures[piece_slot(c, piece.number)] |= (
+                        1 << all_natures.index(n))
+        return bytes(natures)
+
+    def piece_attack(self, attack, piece, s, occupied):
+        """Encode the attack of a piece standing on square s."""
+        c, i = piece.color, piece.number
+        if i in pawn_numbers:
+            attack[attack_slot(c, i, pawn_attack)] = pawn_captures[c][s]
+        else:
+            for (n_ind, n) in enumerate(major_piece_natures):
+                attack[attack_slot(c, i, n_ind)] = nature_attack(
+                    n, s, occupied
+                )
+
     def compute_attack(self):
-        """Encode attack as a binary table."""
-        attack = np.zeros((64, 2, 24, 5))
+        """
+        Encode attack as one bitboard per piece and nature.
+
+        Every nature of a major or promoted piece gets its bitboard, the
+        possible ones are filtered when reading them.
+        """
+        attack = empty_bitboards(48 * 6)
+        occupied = 0
+        for x in range(8):
+            for y in range(8):
+                if self.grid[x][y] is not None:
+                    occupied |= square_mask(x, y)
         for x in range(8):
             for y in range(8):
                 piece = self.grid[x][y]
-                if piece is None:
-                    continue
-                c, i = piece.color, piece.number
-                if (
-                    i in major_piece_numbers or
-                    i in promoted_numbers
-                ):
-                    for s in range(64):
-                        xs, ys = self.get_coord(s)
-                        for n in piece.possible_natures:
-                            n_ind = all_natures.index(n)
-                            if (
-                                self.move_exists(x, y, xs, ys)
-                                and
-                                self.free_trajectory(x, y, xs, ys)
-                                and
-                                self.possible_move(x, y, xs, ys, n, c)
-                            ):
-                                attack[s, c, i, n_ind] = 1
-                elif i in pawn_numbers:
-                    for s in range(64):
-                        xs, ys = self.get_coord(s)
-                        if self.pawn_could_take(x, y, xs, ys, c):
-                            attack[s, c, i, -1] = 1
+                if piece is not None:
+                    s = self.get_square(x, y)
+                    self.piece_attack(attack, piece, s, occupied)
         return attack
 
-    def quantum_explanation(self, check=None):
+    def update_attack(self, x1, y1, x2, y2, piece, target_piece):
         """
-        Perform consistency check with MIP.
+        Derive the attack after a move from the attack before it.
 
-        Returns the solved linear problem.
+        Only the moved and captured pieces change, along with the sliders
+        whose rays stop on or go through (x1, y1) or (x2, y2).
         """
-        major_piece_variables = [
-            (c, i, n)
-            for c in colors
-            for i in major_piece_numbers + promoted_numbers
-            for n in major_piece_natures
-        ]
-
-        z = pulp.LpVariable.dicts(
-            name="z",
-            indexs=major_piece_variables,
-            lowBound=0,
-            upBound=1,
-            cat="Integer"
-        )
-
-        problem = pulp.LpProblem("Chess", 1)
-
-        problem += 1
-
+        attack = self.attacks[-1][:]
+        position = self.positions[-1]
+        moved = square_mask(x1, y1) | square_mask(x2, y2)
+        for other in [piece, target_piece]:
+            if other is not None:
+                slot = attack_slot(other.color, other.number, 0)
+                attack[slot:slot + 6] = empty_bitboards(6)
+
+        occupied = 0
+        for square in position:
+            occupied |= square
         for c in colors:
             for i in major_piece_numbers + promoted_numbers:
+                square = position[piece_slot(c, i)]
+                if not square:
+                    continue
+                s = square.bit_length() - 1
+                for (n_ind, n) in enumerate(major_piece_natures):
+                    slot = attack_slot(c, i, n_ind)
+                    if nature_steps[n][1] and attack[slot] & moved:
+                        attack[slot] = nature_attack(n, s, occupied)
+
+        s2 = self.get_square(x2, y2)
+        self.piece_attack(attack, self.grid[x2][y2], s2, occupied)
+        return attack
+
+    def compute_threats(self, position, attack):
+        """
+        Encode the major pieces under attack as a compact record.
 
-                problem += (
-                    sum([z[(c, i, n)] for n in major_piece_natures]) == 1,
-                    "One nature " + str((c, i))
+        Each of them takes the bytes c, i, the number of pawns attacking it,
+        the number k of other attackers, then k couples (j, mask) giving the
+        attacking piece and the mask of its possible natures doing so.
+        """
+        natures = self.compute_natures()
+        record = bytearray()
+        for c in colors:
+            first, last = attack_slot(1 - c, 0, 0), attack_slot(2 - c, 0, 0)
+            attacked = 0
+            for mask in attack[first:last]:
+                attacked |= mask
+            for i in major_piece_numbers:
+                square = position[piece_slot(c, i)]
+                if not square & attacked:
+                    continue
+                attackers = []
+                for j in major_piece_numbers + promoted_numbers:
+                    mask = 0
+                    for n_ind in range(len(major_piece_natures)):
+                        if attack[attack_slot(1 - c, j, n_ind)] & square:
+                            mask |= 1 << n_ind
+                    mask &= natures[piece_slot(1 - c, j)]
+                    if mask:
+                        attackers.extend([j, mask])
+                pawns = sum(
+                    1 for j in pawn_numbers
+                    if attack[attack_slot(1 - c, j, pawn_attack)] & square
                 )
+                if not attackers and not pawns:
+                    continue
+                record.extend([c, i, pawns, len(attackers) // 2])
+                record.extend(attackers)
+        return bytes(record)
+
+    def history_bytes(self):
+        """Measure the memory taken by the history of the board."""
+        total = sum(sys.getsizeof(record) for record in self.threats)
+        for (position, attack) in zip(self.positions, self.attacks):
+            if position is not None:
+                total += sys.getsizeof(position) + sys.getsizeof(attack)
+        return total
+
+    def bytes_per_ply(self):
+        """Measure the average memory taken by each ply of the history."""
+        return self.history_bytes() / len(self.threats)
+
+    def domains(self):
+        """List the natures each major or promoted piece could have."""
+        return {
+            (c, i): major_piece_natures
+            for c in colors
+            for i in major_piece_numbers + promoted_numbers
+        }
 
+    def rule_constraints(self):
+        """List the constraints that hold for any game."""
+        constraints = []
         for c in colors:
+            majors = tuple((c, i) for i in major_piece_numbers)
             for n in major_piece_natures:
                 if n == "K":
-                    problem += (
-                        sum([z[(c, i, "K")] for i in major_piece_numbers]) == 1,
-                        "Always one king " + str(c)
-                    )
-
+                    constraints.append(Count(majors, "K", 1, 1))
                 else:
-                    problem += (
-                        sum(
-                            [z[(c, i, n)] for i in major_piece_numbers]
-                        ) <= max_quantity[n],
-                        "Maximum quantity " + str((c, n))
-                    )
-
-        for c in colors:
+                    constraints.append(Count(majors, n, 0, max_quantity[n]))
             for i in promoted_numbers:
-                problem += z[(c, i, "K")] == 0, "No promoted king " + str((c, i))
+                constraints.append(Forbidden(c, i, "K"))
+            constraints.append(
+                Count(tuple((c, i) for i in [1, 3, 5, 7]), "B", 1, 1))
+            constraints.append(
+                Count(tuple((c, i) for i in [0, 2, 4, 6]), "B", 1, 1))
+        return constraints
+
+    def king_constraints(self, t, c, kind=NoCheck):
+        """
+        List the constraints on the possible kings of color c at time t.
 
-        for c in colors:
-            problem += (
-                sum([z[(c, i, "B")] for i in [1, 3, 5, 7]]) == 1,
-                "One " + str(c) + "-square bishop " + str(c)
-            )
-            problem += (
-                sum([z[(c, i, "B")] for i in [0, 2, 4, 6]]) == 1,
-                "One " + str(1 - c) + "-square bishop " + str(c)
+        Each major piece of color c standing on a square attacked by the
+        other color gets a constraint of the given kind.
+        """
+        record = self.threats[t]
+        constraints = []
+        k = 0
+        while k < len(record):
+            c_k, i, pawns, m = record[k:k + 4]
+            couples = record[k + 4:k + 4 + 2 * m]
+            k += 4 + 2 * m
+            if c_k != c:
+                continue
+
+            attackers = tuple(
+                (1 - c, j, n)
+                for (j, mask) in zip(couples[::2], couples[1::2])
+                for (n_ind, n) in enumerate(major_piece_natures)
+                if mask & (1 << n_ind)
             )
+            constraints.append(kind(c, i, pawns, attackers))
+
+        return constraints
+
+    def move_constraints(self, t):
+        """List the constraints introduced by the move leading to time t."""
+        constraints = []
+        c, i, move_forbidden_natures = self.nature_eliminations[t - 1]
+        if i in major_piece_numbers + promoted_numbers:
+            for n in move_forbidden_natures:
+                constraints.append(Forbidden(c, i, n))
+        # No king left in check by the player who just moved
+        constraints.extend(self.king_constraints(t, 1 - t % 2))
+        return constraints
+
+    def quantum_explanation(self, check=None, preferred=None):
+        """
+        Perform consistency check with the consistency model.
+
+        The history is already part of the model, only the temporarily
+        forbidden natures and the current check status are added here.
+        The solution favors the preferred (piece, nature) couples if any.
+        Returns the solution and the status.
+        """
+        constraints = []
 
         for c in colors:
             for i in major_piece_numbers + promoted_numbers:
                 piece = self.pieces[c][i]
                 for n in piece.forbidden_natures:
-                    problem += (
-                        z[(c, i, n)] == 0,
-                        "Forbidden nature " + str((c, i, n))
-                    )
-
-        T = self.time
-
-        for t in range(T):
-            c, i, move_forbidden_natures = self.nature_eliminations[t]
-            if i in major_piece_numbers + promoted_numbers:
-                for n in move_forbidden_natures:
-                    problem += (
-                        z[(c, i, n)] == 0,
-                        "Move-forbidden nature " + str((t, c, i, n))
-                    )
-
-        for t in range(1, T + 1):
-            cur_c = t % 2
-            prev_c = 1 - cur_c
-            for s in range(64):
-
-                if self.attacks[t][s, cur_c, :, :].sum() < 0.5:
-                    continue
-                if self.positions[t][s, prev_c, major_piece_numbers].sum() < 0.5:
-                    continue
-
-                dangers = sum([
-                    self.attacks[t][s, cur_c, i, n_ind] * z[(cur_c, i, n)]
-                    for i in major_piece_numbers + promoted_numbers
-                    for (n_ind, n) in enumerate(major_piece_natures)
-                    if self.attacks[t][s, cur_c, i, n_ind] > 0.5
-                ]) + sum([
-                    self.attacks[t][s, cur_c, i, -1]
-                    for i in pawn_numbers
-                ])
-
-                king = sum([
-                    self.positions[t][s, prev_c, i] * z[(prev_c, i, "K")]
-                    for i in major_piece_numbers
-                    if self.positions[t][s, prev_c, i] > 0.5
-                ])
-
-                problem += (
-                    16 * (1 - king) >= dangers,
-                    "No king left in check " + str((t, prev_c, s))
-                )
+                    constraints.append(Forbidden(c, i, n))
 
         if check is not None:
-            cur_c = T % 2
-            prev_c = 1 - cur_c
-
-            for s in range(64):
-
-                if self.attacks[T][s, prev_c, :, :].sum() < 0.5:
-                    continue
-                if self.positions[T][s, cur_c, major_piece_numbers].sum() < 0.5:
-                    continue
-
-                current_dangers = sum([
-                    self.attacks[T][s, prev_c, i, n_ind] * z[(prev_c, i, n)]
-                    for i in major_piece_numbers + promoted_numbers
-                    for (n_ind, n) in enumerate(major_piece_natures)
-                    if self.attacks[T][s, prev_c, i, n_ind] > 0.5
-                ]) + sum([
-                    self.attacks[T][s, prev_c, i, -1]
-                    for i in pawn_numbers
-                ])
-
-                current_king = sum([
-                    self.positions[T][s, cur_c, i] * z[(cur_c, i, "K")]
-                    for i in major_piece_numbers
-                    if self.positions[T][s, cur_c, i] > 0.5
-                ])
-
-                if check == True:
-                    problem += (
-                        current_king <= current_dangers,
-                        "Current king in check " + str(s)
-                    )
-
-                elif check == False:
-                    problem += (
-                        16 * (1 - current_king) >= current_dangers,
-                        "Current king not in check " + str(s)
-                    )
-
-        status = problem.solve()
+            kind = Check if check else NoCheck
+            constraints.extend(
+                self.king_constraints(self.time, self.time % 2, kind))
 
-        return problem, status
+        status, solution = self.model.solve(constraints, preferred)
 
-    def parse_variable(self, var):
-        """Parse pulp variable name."""
-        s = var.name.split("_")
-        c = int(s[1][1])
-        i = int(s[2][0]) if len(s[2]) == 2 else int(s[2][:2])
-        n = s[3][1]
-        return c, i, n
+        return solution, status
 
-    def update_guess(self, problem):
+    def update_guess(self, solution):
         """Update guess with MIP solution."""
-        for v in problem.variables():
-            if v.varValue is not None and v.varValue == 1:
-                c, i, n = self.parse_variable(v)
-                self.pieces[c][i].nature_guess = n
+        for (c, i), n in solution.items():
+            self.pieces[c][i].nature_guess = n
 
     def trivial_test_move(self, x1, y1, x2, y2):
         """Check obvious failures."""
@@ -644,7 +745,23 @@ class ChessBoard():
             alive[target_piece.color] -= 1
         self.pieces_alive.append(alive)
         self.positions.append(self.compute_position())
-        self.attacks.append(self.compute_attack())
+        self.attacks.append(
+            self.update_attack(x1, y1, x2, y2, piece, target_piece))
+        if self.debug and self.attacks[-1] != self.compute_attack():
+            raise RuntimeError("Updated attack differs from recomputed one")
+        self.threats.append(
+            self.compute_threats(self.positions[-1], self.attacks[-1]))
+        if self.memory_cap is not None:
+            ply_bytes = (
+                sys.getsizeof(self.positions[-1]) +
+                sys.getsizeof(self.attacks[-1])
+            )
+            kept = max(2, self.memory_cap // ply_bytes)
+            if len(self.positions) > kept:
+                self.positions[-kept - 1] = None
+                self.attacks[-kept - 1] = None
+        self.constraints.append(self.move_constraints(self.time))
+        self.model.push(self.constraints[-1])
 
     def delete_move_from_history(self, x1, y1, x2, y2, piece, target_piece):
         """Reverse the last move."""
@@ -668,6 +785,12 @@ class ChessBoard():
         self.pieces_alive.pop()
         self.positions.pop()
         self.attacks.pop()
+        self.threats.pop()
+        self.constraints.pop()
+        if self.positions[-1] is None:
+            self.positions[-1] = self.compute_position()
+            self.attacks[-1] = self.compute_attack()
+        self.model.pop()
 
     def test_move(self, x1, y1, x2, y2, full_result=False):
         """
@@ -685,11 +808,11 @@ class ChessBoard():
         self.add_move_to_history(x1, y1, x2, y2, piece, target_piece)
 
         # Check quantum failures (requires history with last move)
-        problem, status = self.quantum_explanation()
+        solution, status = self.quantum_explanation()
 
         self.delete_move_from_history(x1, y1, x2, y2, piece, target_piece)
 
-        if status != 1:
+        if status != FEASIBLE:
             error = (
                 "Trying to perform a move that is illegal for any " +
                 "initial piece configuration"
@@ -697,11 +820,11 @@ class ChessBoard():
             raise IllegalMove(error)
 
         if full_result:
-            return problem
+            return solution
         else:
             return True
 
-    def perform_move(self, x1, y1, x2, y2, problem):
+    def perform_move(self, x1, y1, x2, y2, solution):
         """Perform a move, assuming it is valid."""
         piece = self.grid[x1][y1]
         target_piece = self.grid[x2][y2]
@@ -717,7 +840,7 @@ class ChessBoard():
         if target_piece is not None:
             target_piece.position = False
 
-        self.update_guess(problem)
+        self.update_guess(solution)
 
     def move(self, x1, y1, x2, y2, disp=True):
         """
@@ -725,32 +848,121 @@ class ChessBoard():
 
         Will raise IllegalMove if the move is not valid.
         """
-        problem = self.test_move(x1, y1, x2, y2, full_result=True)
-        self.perform_move(x1, y1, x2, y2, problem)
+        solution = self.test_move(x1, y1, x2, y2, full_result=True)
+        self.perform_move(x1, y1, x2, y2, solution)
         if disp:
             print(self.__str__(guess=0))
         return True
 
-    def legal_moves_from_gen(self, x1, y1):
+    def reachable_squares(self, x1, y1):
+        """
+        List the squares the piece on (x1, y1) could go to.
+
+        These are the moves accepted by trivial_test_move, given the
+        possible natures of the piece.
+        """
+        piece = self.grid[x1][y1]
+        c = piece.color
+        targets = []
+        if "P" in piece.possible_natures:
+            pawn_dir = 1 if c == 0 else -1
+            for v in [pawn_dir, 2 * pawn_dir]:
+                x2, y2 = x1, y1 + v
+                if not self.on_board(x2, y2) or self.grid[x2][y2] is not None:
+                    break
+                if self.pawn_could_reach(x1, y1, x2, y2, c):
+                    targets.append((x2, y2))
+            for h in [-1, 1]:
+                x2, y2 = x1 + h, y1 + pawn_dir
+                if not self.on_board(x2, y2):
+                    continue
+                target_piece = self.grid[x2][y2]
+                if target_piece is not None and target_piece.color != c:
+                    targets.append((x2, y2))
+            return targets
+        for n in piece.possible_natures:
+            steps, repeat = nature_steps[n]
+            for (h, v) in steps:
+                x2, y2 = x1 + h, y1 + v
+                while self.on_board(x2, y2):
+                    target_piece = self.grid[x2][y2]
+                    if target_piece is None or target_piece.color != c:
+                        if (x2, y2) not in targets:
+                            targets.append((x2, y2))
+                    if target_piece is not None or not repeat:
+                        break
+                    x2, y2 = x2 + h, y2 + v
+        return targets
+
+    def pseudo_legal_moves(self, x1=None, y1=None, shuffle=False, seed=None):
+        """
+        List the moves of the player in turn that pass trivial_test_move.
+
+        Only the moves starting from (x1, y1) are listed if it is given.
+        The moves are sorted, or shuffled (reproducibly if a seed is given).
+        """
+        cur_c = self.time % 2
+        if x1 is None:
+            squares = [
+                piece.position for piece in self.pieces[cur_c]
+                if piece.position is not None and piece.position is not False
+            ]
+        elif self.on_board(x1, y1) and self.grid[x1][y1] is not None:
+            squares = [(x1, y1)] if self.grid[x1][y1].color == cur_c else []
+        else:
+            squares = []
+        moves = sorted([
+            (x, y, x2, y2)
+            for (x, y) in squares
+            for (x2, y2) in self.reachable_squares(x, y)
+        ])
+        if shuffle:
+            rng = np.random if seed is None else np.random.RandomState(seed)
+            moves = [moves[k] for k in rng.permutation(len(moves))]
+        return moves
+
+    def legal_moves_from_gen(self, x1, y1, shuffle=True, seed=None):
         """Search all legal moves starting from a given square."""
-        X2, Y2 = range(8), range(8)
-        couples = np.random.permutation(
-            list(itertools.product(X2, Y2))
-        )
-        for x2, y2 in couples:
+        if self.pool is not None:
+            moves = self.pseudo_legal_moves(x1, y1, shuffle, seed)
+            for (x1, y1, x2, y2) in self.pool.stream(
+                parallel.check_moves, moves
+            ):
+                yield (x2, y2)
+            return
+        for (x1, y1, x2, y2) in self.pseudo_legal_moves(x1, y1, shuffle, seed):
             try:
                 self.test_move(x1, y1, x2, y2, full_result=False)
                 yield (x2, y2)
             except IllegalMove:
                 pass
 
-    def all_legal_moves_gen(self):
+    def likely_legal_first(self, moves):
+        """
+        Order moves so that the likely legal ones come first.
+
+        Pawn moves rarely expose a king, and the guessed king is the piece
+        most likely to escape a check, so they are tried before the others.
+        """
+        def rank(move):
+            piece = self.grid[move[0]][move[1]]
+            if "P" in piece.possible_natures:
+                return 0
+            elif piece.nature_guess == "K":
+                return 1
+            return 2
+        return sorted(moves, key=rank)
+
+    def all_legal_moves_gen(self, shuffle=True, seed=None, likely_first=False):
         """Search all legal move at a given turn."""
-        X1, Y1, X2, Y2 = range(8), range(8), range(8), range(8)
-        quadruples = np.random.permutation(
-            list(itertools.product(X1, Y1, X2, Y2))
-        )
-        for x1, y1, x2, y2 in quadruples:
+        moves = self.pseudo_legal_moves(shuffle=shuffle, seed=seed)
+        if likely_first:
+            moves = self.likely_legal_first(moves)
+        if self.pool is not None:
+            for move in self.pool.stream(parallel.check_moves, moves):
+                yield move
+            return
+        for x1, y1, x2, y2 in moves:
             try:
                 self.test_move(x1, y1, x2, y2, full_result=False)
                 yield (x1, y1, x2, y2)
@@ -763,7 +975,14 @@ class ChessBoard():
     def all_legal_moves(self):
         return sorted(list(self.all_legal_moves_gen()))
 
-    def sunfish_move_suggestion(self, secs):
+    def sunfish_position(self, natures=None):
+        """
+        Convert the board to a sunfish position of the player in turn.
+
+        Pieces get their natures from natures, indexed by (c, i), if
+        given, else their guessed natures. The position is scored as if
+        sunfish had reached it, so that the kept searcher tables apply.
+        """
         board = (
             "         \n"
             "         \n"
@@ -771,46 +990,160 @@ class ChessBoard():
         for y in reversed(range(8)):
             board += ' '
             for x in range(8):
-                if self.grid[x][y] is None:
+                piece = self.grid[x][y]
+                if piece is None:
                     board += '.'
-                elif self.grid[x][y].color_name == "W":
-                    board += self.grid[x][y].nature_guess
-                else:
-                    board += self.grid[x][y].nature_guess.lower()
+                    continue
+                n = piece.nature_guess
+                if natures is not None:
+                    n = natures.get((piece.color, piece.number), n)
+                board += n if piece.color_name == "W" else n.lower()
             board += '\n'
         board += (
             "         \n"
             "         \n"
         )
         pos = sunfish.Position(
-            board, 0, (False, False), (False, False), 0, 0
+            board, sunfish.board_score(board), (False, False), (False, False),
+            0, 0
         )
         if self.time % 2 == 1:
             pos = pos.rotate()
+        return pos
 
-        searcher = sunfish.Searcher()
-        move, score = searcher.search(pos, secs=secs)
-        if move is None:
-            raise IllegalMove("Sunfish didn't find a feasible move")
+    def sunfish_translate(self, move):
+        """Convert a sunfish move of the player in turn to (x1, y1, x2, y2)."""
         if self.time % 2 == 1:
             move = (119-move[0], 119-move[1])
         first_square, last_square = sunfish.render(move[0]), sunfish.render(move[1])
-        x1, y1, x2, y2 = self.translate_move((first_square, last_square))
-        return x1, y1, x2, y2
+        return self.translate_move((first_square, last_square))
 
-    def auto_move(self, intelligent=True, secs=1):
-        """Perform one of the legal moves at random."""
-        if intelligent:
-            try:
-                x1, y1, x2, y2 = self.sunfish_move_suggestion(secs=secs)
-                self.test_move(x1, y1, x2, y2)
-            except IllegalMove:
-                self.auto_move(intelligent=False)
+    def sunfish_search(self, pos, budget, stop=None):
+        """
+        Search the best sunfish move of a position with the board searcher.
+
+        The budget gives the secs, nodes, depth and hard arguments of
+        sunfish.Searcher.search, and the search aborts once stop is set.
+        """
+        if self.searcher is None:
+            self.searcher = sunfish.Searcher()
+        return self.searcher.search(pos, stop=stop, **budget)
+
+    def sunfish_move_suggestion(self, secs):
+        """Suggest the sunfish move of the guessed natures."""
+        move, score = self.sunfish_search(self.sunfish_position(), {"secs": secs})
+        if move is None:
+            raise IllegalMove("Sunfish didn't find a feasible move")
+        return self.sunfish_translate(move)
+
+    def nature_samples(self, k, seed=None):
+        """
+        Sample up to k distinct consistent nature assignments.
+
+        Each sample is the solution favoring a random possible nature of
+        every piece on the board whose nature is not known yet.
+        """
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        unknown = [
+            piece for c in colors for piece in self.pieces[c]
+            if piece.position and len(piece.possible_natures) > 1
+        ]
+        samples = []
+        for _ in range(k):
+            preferred = set(
+                ((piece.color, piece.number),
+                 piece.possible_natures[rng.randint(len(piece.possible_natures))])
+                for piece in unknown
+            )
+            solution, status = self.quantum_explanation(preferred=preferred)
+            if status != FEASIBLE:
+                break
+            if solution not in samples:
+                samples.append(solution)
+        return samples
+
+    def sampled_move_suggestions(
+        self, budget, samples=auto_move_samples, seed=None, stop=None
+    ):
+        """
+        Rank the moves sunfish suggests over sampled nature assignments.
+
+        The samples are searched by the pool workers if any, each within
+        the budget, else one after the other, sharing the seconds and nodes
+        of the budget. Only pseudo-legal moves are kept, the most suggested
+        first, then the best scored on average. Unseeded suggestions are kept
+        for the same history and budget. Once stop is set, the searches of
+        this process abort and no move is suggested.
+        """
+        request = (tuple(self.moves), tuple(sorted(budget.items())), samples)
+        if seed is None and self.suggestions is not None:
+            if self.suggestions[0] == request:
+                return self.suggestions[1]
+        positions = [
+            self.sunfish_position(natures)
+            for natures in self.nature_samples(samples, seed)
+        ]
+        if not positions:
+            return []
+        if self.pool is not None:
+            results = list(self.pool.stream(
+                parallel.search_positions, [(pos, budget) for pos in positions]
+            ))
         else:
-            try:
-                x1, y1, x2, y2 = self.all_legal_moves_gen().__next__()
-            except StopIteration:
-                raise IllegalMove("Game over - " + self.end_game())
+            share = dict(budget)
+            for key in ["secs", "hard"]:
+                if share[key] is not None:
+                    share[key] = share[key] / len(positions)
+            if share["nodes"] is not None:
+                share["nodes"] = max(1, share["nodes"] // len(positions))
+            results = [
+                self.sunfish_search(pos, share, stop) for pos in positions
+            ]
+        if stop is not None and stop.is_set():
+            return []
+        pseudo_legal = set(self.pseudo_legal_moves())
+        scores = defaultdict(list)
+        for move, score in results:
+            if move is None:
+                continue
+            move = self.sunfish_translate(move)
+            if move in pseudo_legal:
+                scores[move].append(score)
+        suggestions = sorted(
+            scores,
+            key=lambda m: (-len(scores[m]), -sum(scores[m]) / len(scores[m]))
+        )
+        if seed is None:
+            self.suggestions = (request, suggestions)
+        return suggestions
+
+    def auto_move(
+        self, intelligent=True, secs=1, samples=auto_move_samples,
+        nodes=None, depth=None, hard=None, seed=None
+    ):
+        """
+        Choose a legal move.
+
+        The intelligent choice is the first legal move among those sunfish
+        suggests over the sampled nature assignments, else the choice is a legal
+        move at random. The search stops at the first exhausted budget among
+        secs (soft deadline), nodes, depth and hard (hard deadline). Without a
+        pool, a node or depth budget and a seed give reproducible choices.
+        """
+        if intelligent:
+            budget = {"secs": secs, "nodes": nodes, "depth": depth, "hard": hard}
+            for x1, y1, x2, y2 in self.sampled_move_suggestions(
+                budget, samples, seed
+            ):
+                try:
+                    self.test_move(x1, y1, x2, y2)
+                    return x1, y1, x2, y2
+                except IllegalMove:
+                    pass
+        try:
+            x1, y1, x2, y2 = self.all_legal_moves_gen(seed=seed).__next__()
+        except StopIteration:
+            raise IllegalMove("Game over - " + self.end_game())
         return x1, y1, x2, y2
 
     def is_legal_nature(self, piece, n):
@@ -823,28 +1156,123 @@ class ChessBoard():
         piece.forbidden_natures = [
             other_n for other_n in major_piece_natures if other_n != n
         ]
-        problem, status = self.quantum_explanation()
-        is_legal_nature_n = (status == 1)
+        solution, status = self.quantum_explanation()
+        is_legal_nature_n = (status == FEASIBLE)
         piece.forbidden_natures = []
         return is_legal_nature_n
 
     def all_legal_natures(self, piece, update=True):
         """Search all legal natures a piece could have."""
         legal_natures = []
-        for n in all_natures:
-            if self.is_legal_nature(piece, n):
-                legal_natures.append(n)
+        if self.pool is not None and len(piece.possible_natures) > 1:
+            couples = [
+                (piece.color, piece.number, n) for n in all_natures
+                if n in piece.possible_natures
+            ]
+            legal = set(self.pool.stream(parallel.check_natures, couples))
+            for (c, i, n) in couples:
+                if (c, i, n) in legal:
+                    legal_natures.append(n)
+        else:
+            for n in all_natures:
+                if self.is_legal_nature(piece, n):
+                    legal_natures.append(n)
         if update:
             piece.possible_natures = legal_natures[:]
         return legal_natures
 
+    def legal_natures_all_pieces(self, update=True):
+        """
+        Search all legal natures of every piece at once.
+
+        Every solution found proves one legal nature for each piece, so a
+        nature only needs a solve of its own if no previous solution
+        already used it. Solutions favor the natures not proven yet, and
+        natures ruled out by propagation alone are never tried.
+        Returns the legal natures, indexed like self.pieces.
+        """
+        pruned = self.model.prune()
+        pending = set()
+        for c in colors:
+            for piece in self.pieces[c]:
+                if len(piece.possible_natures) > 1:
+                    for n in piece.possible_natures:
+                        if Forbidden(c, piece.number, n) in self.rules:
+                            continue
+                        if (
+                            pruned is not None and
+                            n not in pruned[(c, piece.number)]
+                        ):
+                            continue
+                        pending.add(((c, piece.number), n))
+
+        witnessed = set()
+        solution, status = self.quantum_explanation(preferred=pending)
+        if status == FEASIBLE:
+            witnessed.update(solution.items())
+
+        for c in colors:
+            for piece in self.pieces[c]:
+                for n in all_natures:
+                    couple = ((c, piece.number), n)
+                    if couple not in pending or couple in witnessed:
+                        continue
+                    piece.forbidden_natures = [
+                        other_n for other_n in major_piece_natures
+                        if other_n != n
+                    ]
+                    solution, status = self.quantum_explanation(
+                        preferred=pending - witnessed)
+                    piece.forbidden_natures = []
+                    if status == FEASIBLE:
+                        witnessed.update(solution.items())
+
+        legal_natures = [
+            [
+                [
+                    n for n in all_natures
+                    if n in piece.possible_natures and (
+                        len(piece.possible_natures) == 1 or
+                        ((c, piece.number), n) in witnessed
+                    )
+                ]
+                for piece in self.pieces[c]
+            ]
+            for c in colors
+        ]
+
+        if update:
+            for c in colors:
+                for piece, natures in zip(self.pieces[c], legal_natures[c]):
+                    piece.possible_natures = natures[:]
+        return legal_natures
+
+    def has_legal_move(self):
+        """Check whether a legal move exists, stopping at the first one."""
+        moves = self.all_legal_moves_gen(shuffle=False, likely_first=True)
+        found = next(moves, None) is not None
+        moves.close()
+        return found
+
     def end_game(self):
-        if len(self.all_legal_moves()) > 0:
+        """
+        Decide whether the game is over for the player in turn.
+
+        The verdict is kept until the history changes.
+        """
+        history = tuple(self.moves)
+        if self.verdict is None or self.verdict[0] != history:
+            self.verdict = (history, self.compute_end_game())
+        return self.verdict[1]
+
+    def compute_end_game(self):
+        """Decide whether the game is over, without the kept verdict."""
+        if self.has_legal_move():
             return "Legal moves still exist"
-        problem1, status1 = self.quantum_explanation(check=True)
-        problem2, status2 = self.quantum_explanation(check=False)
-        checkmate_possible = (status1 == 1)
-        stalemate_possible = (status2 == 1)
+        solution1, status1 = self.quantum_explanation(check=True)
+        solution2, status2 = self.quantum_explanation(check=False)
+        checkmate_possible = (status1 == FEASIBLE)
+        stalemate_possible = (status2 == FEASIBLE)
         if checkmate_possible and stalemate_possible:
             return "Result unclear"
         elif checkmate_possible:
@@ -913,6 +1341,8 @@ class ChessBoard():
 
 class LightBoard():
     def __init__(self):
+        # Number of the last update received from the server
+        self.version = 0
         self.pieces = []
         for j in range(8):
             self.pieces.append({"position": (j, 0), "color": 0, "natures": major_piece_natures})
@@ -1017,6 +1447,23 @@ class LightBoard():
     def unwrap(self, wrap):
         self.pieces = wrap
 
+    def copy(self):
+        other = LightBoard()
+        other.version = self.version
+        other.pieces = list(self.pieces)
+        return other
+
+    def delta(self, other):
+        """List the (index, piece) that differ from another light board."""
+        return [
+            (i, piece) for i, piece in enumerate(self.pieces)
+            if piece != other.pieces[i]
+        ]
+
+    def applyDelta(self, delta):
+        for i, piece in delta:
+            self.pieces[i] = piece
+
 
 def main():
     """Main."""
@@ -1,10 +1,13 @@
-from twisted.internet.protocol import Protocol
+from twisted.protocols.basic import Int32StringReceiver
 
-import json
+from wire import encode, decode
 
-class ChessClientProtocol(Protocol):
+class ChessClientProtocol(Int32StringReceiver):
 
-    """ Class which handles the communication protocol between the game client and the game server."""
+    """
+    Class which handles the communication protocol between the game client and the game server.
+    Each message is a JSON object prefixed by its length on 4 bytes.
+    """
 
     def __init__(self, client):
         """
@@ -13,45 +16,49 @@ class ChessClientProtocol(Protocol):
         """
         self.client = client # reference to the client (a GameEngine object)
         self.state = "INITIALIZATION"
+        self.binary = False # whether the server accepts binary messages
 
     def connectionMade(self):
-        self.sendMessage({"type" : "player-info", "player-name" : self.client.name, "color": self.client.color})
+        self.sendMessage({"type" : "player-info", "player-name" : self.client.name, "color": self.client.color, "formats": ["binary", "json"], "resume_token": self.client.resumeToken})
 
-    def dataReceived(self, data):
+    def stringReceived(self, data):
 
         """
-        Handles the reception of data from the server.
-        :param data: A byte representing a JSON-encoded object (default encoding UTF-8)
+        Handles the reception of a message from the server.
+        :param data: Bytes of a JSON-encoded object (default encoding UTF-8) or of a binary message
         """
-        messages = self.split_messages(data)
+        msg = decode(data)
 
-        for msg_json in messages:
-            msg = json.loads(msg_json)
-            
-            if self.state == "INITIALIZATION":
-                if msg["type"] == "greetings":
-                    self.client.handleInit()
-                self.state = "PLAYING"
-            elif self.state == "PLAYING":
-                if msg["type"] == "chat":
-                    self.client.display.addMessage(msg["content"])
-                if msg["type"] == "move":
-                    self.client.handleMove(msg["description"])
-                elif msg["type"] == "illegal-move":
-                    self.client.handleIllegalMove(msg["description"])
-                elif msg["type"] == "status":
-                    if msg["status"] == "ready":
-                        self.client.handleReady()
-                elif msg["type"] == "lightboard":
-                    self.client.handleUpdateBoard(msg["description"])
-                elif msg["type"] == "checks":
-                    self.client.handleChecks(msg["description"])
-                elif msg["type"] == "checkmates":
-                    self.client.CheckMates(msg["description"])
-                elif msg["type"] == "disconnection":
-                    self.client.handleDisconnection(msg["description"])
-                else:
-                    pass
+        if self.state == "INITIALIZATION":
+            if msg["type"] == "greetings":
+                self.client.handleInit(msg.get("resume_token"))
+            self.state = "PLAYING"
+        elif self.state == "PLAYING":
+            if msg["type"] == "format":
+                self.binary = (msg["format"] == "binary")
+            elif msg["type"] == "chat":
+                self.client.display.addMessage(msg["content"])
+            if msg["type"] == "move":
+                self.client.handleMove(msg["description"])
+            elif msg["type"] == "illegal-move":
+                self.client.handleIllegalMove(msg["description"])
+            elif msg["type"] == "status":
+                if msg["status"] == "ready":
+                    self.client.handleReady(msg.get("color"))
+                elif msg["status"] == "resumed":
+                    self.client.handleResumed(msg["resume_token"], msg["turn"])
+            elif msg["type"] == "lightboard":
+                self.client.handleUpdateBoard(msg["description"], msg["version"])
+            elif msg["type"] == "lightboard-delta":
+                self.client.handleBoardDelta(msg["description"], msg["base"], msg["version"])
+            elif msg["type"] == "checks":
+                self.client.handleChecks(msg["description"])
+            elif msg["type"] == "checkmates":
+                self.client.CheckMates(msg["description"])
+            elif msg["type"] == "disconnection":
+                self.client.handleDisconnection(msg["description"], final=True)
+            else:
+                pass
 
     def connectionLost(self, reason):
         """
@@ -65,18 +72,4 @@ class ChessClientProtocol(Protocol):
         Sends a message to the server using the protocol.
         :param msg: A dictionary representing a message.
         """
-        self.transport.write(json.dumps(msg).encode())
-
-    def split_messages(self, data):
-        messages = []
-        split = data.decode().split("}{")
-        if len(split) == 1:
-            return split
-        for i, sp in enumerate(split):
-            m = sp
-            if i > 0:
-                m = "{" + m
-            if i < len(split)-1:
-                m = m + "}"
-            messages.append(m)
-        return messages
+        self.sendString(encode(msg, self.binary))
@@ -0,0 +1,596 @@
+"""Persistent consistency models for the quantum explanation."""
+
+import threading
+from collections import namedtuple, OrderedDict
+
+import pulp
+
+# Constraints are described independently of the solver that enforces them.
+# Each variable is a piece (c, i) whose nature has to be chosen in its domain.
+
+
+class Constraint():
+    """
+    Kind of constraint, whose instances only equal those of the same kind,
+    so that constraints with the same fields stay apart in sets and keys.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, tuple.__hash__(self)))
+
+
+class Forbidden(Constraint, namedtuple("Forbidden", "c i n")):
+    """Piece (c, i) cannot have nature n."""
+    __slots__ = ()
+
+
+class Count(Constraint, namedtuple("Count", "pieces n lower upper")):
+    """
+    Between lower and upper of the pieces have nature n (lower is either 0
+    or equal to upper).
+    """
+    __slots__ = ()
+
+
+class NoCheck(Constraint, namedtuple("NoCheck", "c i pawns attackers")):
+    """
+    If piece (c, i) is a king, none of the attackers (c', i', n') nor pawns
+    threaten it.
+    """
+    __slots__ = ()
+
+
+class Check(Constraint, namedtuple("Check", "c i pawns attackers")):
+    """If piece (c, i) is a king, at least one attacker or pawn threatens it."""
+    __slots__ = ()
+
+FEASIBLE = 1
+INFEASIBLE = -1
+
+# Maximum number of answers kept in the feasibility cache
+CACHE_SIZE = 10000
+
+
+class PulpModel():
+    """
+    MIP model kept alive for the whole game.
+
+    The history is stored as a stack of constraint groups, one per move, so
+    that the latest move can be added or removed without regenerating the
+    previous ones.
+    """
+
+    def __init__(self, domains, constraints):
+        """
+        Create the variables and the constraints that never change.
+
+        :param domains: Dictionary mapping each piece (c, i) to its natures.
+        :param constraints: List of constraints valid for the whole game.
+        """
+        self.domains = domains
+        self.z = {
+            (c, i, n): pulp.LpVariable(
+                name="z_" + str((c, i, n)), lowBound=0, upBound=1,
+                cat="Integer"
+            )
+            for (c, i), natures in domains.items()
+            for n in natures
+        }
+        self.problem = pulp.LpProblem("Chess", 1)
+        # A constant objective would make pulp add a dummy variable that
+        # breaks later solves with another objective
+        self.objective = pulp.LpAffineExpression(
+            [(variable, 0) for variable in self.z.values()])
+        self.problem.setObjective(self.objective)
+        for (c, i), natures in domains.items():
+            self.problem += (
+                sum([self.z[(c, i, n)] for n in natures]) == 1,
+                "One nature " + str((c, i))
+            )
+        self.counter = 0
+        self.add(constraints)
+        self.stack = []
+
+    def translate(self, constraint):
+        """Turn a constraint into a pulp affine inequality."""
+        if isinstance(constraint, Forbidden):
+            c, i, n = constraint
+            return self.z[(c, i, n)] == 0
+        elif isinstance(constraint, Count):
+            total = sum([self.z[(c, i, constraint.n)]
+                         for (c, i) in constraint.pieces])
+            if constraint.lower == constraint.upper:
+                return total == constraint.lower
+            return total <= constraint.upper
+        king = self.z[(constraint.c, constraint.i, "K")]
+        dangers = sum([
+            self.z[attacker] for attacker in constraint.attackers
+        ]) + constraint.pawns
+        if isinstance(constraint, NoCheck):
+            return 16 * (1 - king) >= dangers
+        elif isinstance(constraint, Check):
+            return king <= dangers
+
+    def add(self, constraints):
+        """Add constraints to the problem and return their names."""
+        names = []
+        for constraint in constraints:
+            name = type(constraint).__name__ + "_" + str(self.counter)
+            self.counter += 1
+            self.problem += self.translate(constraint), name
+            names.append(name)
+        return names
+
+    def remove(self, names):
+        """Remove constraints from the problem."""
+        for name in names:
+            del self.problem.constraints[name]
+
+    def push(self, constraints):
+        """Add the constraints introduced by a new move."""
+        self.stack.append(self.add(constraints))
+
+    def pop(self):
+        """Remove the constraints introduced by the last move."""
+        self.remove(self.stack.pop())
+
+    def prune(self, constraints=()):
+        """Natures left by propagation alone, not available with MIP."""
+        return None
+
+    def solve(self, constraints=(), preferred=None):
+        """
+        Solve the problem with a few additional temporary constraints.
+
+        If preferred (piece, nature) couples are given, the solution uses
+        as many of them as possible.
+        Returns the status and a dictionary mapping pieces to natures.
+        """
+        names = self.add(constraints)
+        if preferred:
+            self.problem.setObjective(self.objective - sum([
+                self.z[(c, i, n)] for ((c, i), n) in preferred
+                if (c, i, n) in self.z
+            ]))
+        status = self.problem.solve()
+        self.problem.setObjective(self.objective)
+        self.remove(names)
+        if status != FEASIBLE:
+            return INFEASIBLE, None
+        solution = {
+            (c, i): n
+            for (c, i, n), variable in self.z.items()
+            if variable.varValue is not None and variable.varValue > 0.5
+        }
+        return FEASIBLE, solution
+
+
+class PropagationModel():
+    """
+    Constraint propagation model solved in-process.
+
+    Each piece has a bitmask of possible natures. The constraints are
+    compiled into cardinality constraints and clauses, propagated until a
+    fixed point and combined with a backtracking search on the pieces with
+    the fewest natures left.
+    """
+
+    def __init__(self, domains, constraints):
+        """
+        Create the variables and the constraints that never change.
+
+        :param domains: Dictionary mapping each piece (c, i) to its natures.
+        :param constraints: List of constraints valid for the whole game.
+        """
+        self.domains = domains
+        self.variables = list(domains)
+        self.index = {piece: v for (v, piece) in enumerate(self.variables)}
+        self.natures = []
+        for natures in domains.values():
+            for n in natures:
+                if n not in self.natures:
+                    self.natures.append(n)
+        self.bit = {n: 1 << k for (k, n) in enumerate(self.natures)}
+        # Single nature bits and number of natures of every mask
+        self.bits = [
+            [1 << k for k in range(len(self.natures)) if mask & (1 << k)]
+            for mask in range(1 << len(self.natures))
+        ]
+        self.size = [len(bits) for bits in self.bits]
+        self.root = [
+            sum([self.bit[n] for n in domains[piece]])
+            for piece in self.variables
+        ]
+        self.compiled = {}
+        # Number of times each constraint appears in the history
+        self.active = {}
+        # Compiled constraints watching each variable
+        self.watches = [[] for v in self.variables]
+        # Constraints of each move, with the ones compiled for it
+        self.stack = []
+        # Domains propagated with the history up to each move
+        self.fixpoints = []
+        self.push(constraints)
+
+    def compile(self, constraint):
+        """
+        Turn a constraint into a cardinality constraint or a clause.
+
+        A clause is a list of literals (v, mask, positive), meaning that the
+        nature of variable v belongs (or not) to the mask.
+        """
+        if constraint in self.compiled:
+            return self.compiled[constraint]
+        if isinstance(constraint, Forbidden):
+            c, i, n = constraint
+            compiled = ("clause", [(self.index[(c, i)], self.bit[n], False)])
+        elif isinstance(constraint, Count):
+            compiled = (
+                "count",
+                [self.index[piece] for piece in constraint.pieces],
+                self.bit[constraint.n],
+                constraint.lower,
+                constraint.upper
+            )
+        else:
+            king = (self.index[(constraint.c, constraint.i)], self.bit["K"])
+            attackers = [
+                (self.index[(c, i)], self.bit[n])
+                for (c, i, n) in constraint.attackers
+            ]
+            if isinstance(constraint, NoCheck):
+                if constraint.pawns > 0:
+                    compiled = [
+                        ("clause", [king + (False,)])
+                    ]
+                else:
+                    compiled = [
+                        ("clause", [king + (False,), attacker + (False,)])
+                        for attacker in attackers
+                    ]
+            elif constraint.pawns > 0:
+                compiled = []
+            else:
+                compiled = [
+                    ("clause", [king + (False,)] + [
+                        attacker + (True,) for attacker in attackers
+                    ])
+                ]
+        if not isinstance(compiled, list):
+            compiled = [compiled]
+        self.compiled[constraint] = compiled
+        return compiled
+
+    def scope(self, compiled):
+        """List the variables of a compiled constraint, once each."""
+        if compiled[0] == "count":
+            return compiled[1]
+        return list(dict.fromkeys(v for (v, mask, positive) in compiled[1]))
+
+    def watch(self, compiled):
+        """Register compiled constraints in the watch lists."""
+        for con in compiled:
+            for v in self.scope(con):
+                self.watches[v].append(con)
+
+    def unwatch(self, compiled):
+        """Remove the compiled constraints registered last."""
+        for con in reversed(compiled):
+            for v in self.scope(con):
+                self.watches[v].pop()
+
+    def push(self, constraints):
+        """
+        Add the constraints introduced by a new move.
+
+        Only the constraints that are new to the history are compiled and
+        propagated, starting from the domains of the previous move.
+        """
+        added = []
+        for constraint in constraints:
+            self.active[constraint] = self.active.get(constraint, 0) + 1
+            if self.active[constraint] == 1:
+                added.extend(self.compile(constraint))
+        self.watch(added)
+        self.stack.append((constraints, added))
+        domain = self.fixpoints[-1] if self.fixpoints else self.root
+        if domain is not None:
+            domain = domain[:]
+            if not self.propagate(domain, added[:]):
+                domain = None
+        self.fixpoints.append(domain)
+
+    def pop(self):
+        """Remove the constraints introduced by the last move."""
+        constraints, added = self.stack.pop()
+        self.fixpoints.pop()
+        self.unwatch(added)
+        for constraint in constraints:
+            self.active[constraint] -= 1
+            if self.active[constraint] == 0:
+                del self.active[constraint]
+
+    def revise(self, domain, compiled):
+        """
+        Filter the domains according to one compiled constraint.
+
+        Returns the list of variables whose domain changed, or None if the
+        constraint cannot be satisfied.
+        """
+        changed = []
+        if compiled[0] == "count":
+            _, variables, bit, lower, upper = compiled
+            assigned = [v for v in variables if domain[v] == bit]
+            possible = [v for v in variables if domain[v] & bit]
+            if len(assigned) > upper or len(possible) < lower:
+                return None
+            if len(assigned) == upper:
+                for v in possible:
+                    if domain[v] != bit:
+                        domain[v] &= ~bit
+                        if domain[v] == 0:
+                            return None
+                        changed.append(v)
+            if len(possible) == lower:
+                for v in possible:
+                    if domain[v] != bit:
+                        domain[v] = bit
+                        changed.append(v)
+            return changed
+        unknown = None
+        for literal in compiled[1]:
+            v, mask, positive = literal
+            inside = domain[v] & mask
+            outside = domain[v] & ~mask
+            if positive:
+                if not outside:
+                    return changed
+                if not inside:
+                    continue
+            else:
+                if not inside:
+                    return changed
+                if not outside:
+                    continue
+            if unknown is not None:
+                return changed
+            unknown = literal
+        if unknown is None:
+            return None
+        v, mask, positive = unknown
+        domain[v] = domain[v] & mask if positive else domain[v] & ~mask
+        changed.append(v)
+        return changed
+
+    def propagate(self, domain, queue):
+        """Revise constraints until nothing changes, return False on failure."""
+        watches = self.watches
+        queued = set(map(id, queue))
+        while queue:
+            compiled = queue.pop()
+            queued.discard(id(compiled))
+            changed = self.revise(domain, compiled)
+            if changed is None:
+                return False
+            for v in changed:
+                for other in watches[v]:
+                    if id(other) not in queued:
+                        queued.add(id(other))
+                        queue.append(other)
+        return True
+
+    def search(self, domain, preferred):
+        """
+        Backtrack on the variable with the fewest natures left.
+
+        Variables that still have preferred natures are decided first, and
+        their preferred natures are tried first. Variables that no
+        constraint watches can take any nature of their domain, so they are
+        left undecided.
+        """
+        watches = self.watches
+        best, best_key = None, None
+        for v, d in enumerate(domain):
+            if not watches[v] or self.size[d] < 2:
+                continue
+            key = (not d & preferred[v], self.size[d])
+            if best is None or key < best_key:
+                best, best_key = v, key
+        if best is None:
+            return domain
+        d = domain[best]
+        for bit in self.bits[d & preferred[best]] + self.bits[d & ~preferred[best]]:
+            child = domain[:]
+            child[best] = bit
+            if not self.propagate(child, list(watches[best])):
+                continue
+            solution = self.search(child, preferred)
+            if solution is not None:
+                return solution
+        return None
+
+    def temporary(self, constraints):
+        """Compile the additional constraints absent from the history."""
+        compiled = []
+        for constraint in dict.fromkeys(constraints):
+            if constraint not in self.active:
+                compiled.extend(self.compile(constraint))
+        return compiled
+
+    def root_propagation(self, compiled):
+        """
+        Propagate watched temporary constraints before any search.
+
+        Starts from the domains of the last move, on which the history is
+        already propagated. Returns the filtered domains, None on failure.
+        """
+        domain = self.fixpoints[-1]
+        if domain is None:
+            return None
+        domain = domain[:]
+        if not self.propagate(domain, compiled[:]):
+            return None
+        return domain
+
+    def prune(self, constraints=()):
+        """
+        List the natures left to each piece by propagation alone.
+
+        Every nature removed is impossible, but the ones left are not all
+        possible. Returns None if the problem is infeasible.
+        """
+        compiled = self.temporary(constraints)
+        self.watch(compiled)
+        try:
+            domain = self.root_propagation(compiled)
+        finally:
+            self.unwatch(compiled)
+        if domain is None:
+            return None
+        return {
+            piece: [n for n in self.natures if d & self.bit[n]]
+            for (piece, d) in zip(self.variables, domain)
+        }
+
+    def solve(self, constraints=(), preferred=None):
+        """
+        Solve the problem with a few additional temporary constraints.
+
+        If preferred (piece, nature) couples are given, they are tried
+        first during the search.
+        Returns the status and a dictionary mapping pieces to natures.
+        """
+        masks = [0 for v in self.variables]
+        for (piece, n) in preferred or ():
+            if piece in self.index:
+                masks[self.index[piece]] |= self.bit[n]
+        compiled = self.temporary(constraints)
+        self.watch(compiled)
+        try:
+            domain = self.root_propagation(compiled)
+            if domain is not None:
+                domain = self.search(domain, masks)
+        finally:
+            self.unwatch(compiled)
+        if domain is None:
+            return INFEASIBLE, None
+        solution = {
+            piece: n
+            for (piece, d, mask) in zip(self.variables, domain, masks)
+            for n in self.natures
+            if (self.bits[d & mask] or self.bits[d])[0] == self.bit[n]
+        }
+        return FEASIBLE, solution
+
+
+class FeasibilityCache():
+    """
+    Store the answers to the last consistency queries.
+
+    The boards of a process share the cache from any thread, so every
+    access holds a lock.
+    """
+
+    def __init__(self, size):
+        self.od = OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.od)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.od.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self.od[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.od.pop(key, None)
+            while len(self.od) >= self.size:
+                self.od.popitem(last=False)
+            self.od[key] = value
+
+    def clear(self):
+        """Forget every answer and reset the counters."""
+        with self.lock:
+            self.od.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by every board of the process
+feasibility_cache = FeasibilityCache(CACHE_SIZE)
+
+
+class CachedModel():
+    """
+    Consistency model answering repeated queries from a cache.
+
+    The key of a query is the set of all the constraints involved, so that
+    identical queries are recognized whatever the order of the moves that
+    led to them, on any board sharing the cache.
+    """
+
+    def __init__(self, model, constraints, cache):
+        """
+        Wrap a model.
+
+        :param model: Model solving the queries missing from the cache.
+        :param constraints: Constraints the model was created with.
+        :param cache: FeasibilityCache storing the answers.
+        """
+        self.model = model
+        self.cache = cache
+        # The set of constraints after each move, sharing their hashes
+        self.keys = [frozenset(constraints)]
+
+    def push(self, constraints):
+        """Add the constraints introduced by a new move."""
+        self.model.push(constraints)
+        self.keys.append(self.keys[-1].union(constraints))
+
+    def pop(self):
+        """Remove the constraints introduced by the last move."""
+        self.model.pop()
+        self.keys.pop()
+
+    def prune(self, constraints=()):
+        """List the natures left to each piece by propagation alone."""
+        return self.model.prune(constraints)
+
+    def solve(self, constraints=(), preferred=None):
+        """
+        Solve the problem unless the answer is already known.
+
+        Preferred natures change the solution returned, so they are part
+        of the key along with the constraints.
+        """
+        key = (
+            self.keys[-1], frozenset(constraints), frozenset(preferred or ())
+        )
+        answer = self.cache.get(key)
+        if answer is None:
+            answer = self.model.solve(constraints, preferred)
+            self.cache[key] = answer
+        return answer
+
+
+backends = {
+    "pulp": PulpModel,
+    "propagation": PropagationModel,
+}
@@ -0,0 +1,13 @@
+Feature: Tests the budgets of the auto-moves
+
+  Scenario: Auto-moves within a node budget are reproducible
+    Given I have two standard Schroedinger ChessBoards
+    When both boards play 4 auto-moves within 2000 nodes with seed 7
+    Then both boards should have played the same moves
+    Then no auto-move should have searched over 2000 nodes
+
+  Scenario: The node budget also caps the first depth of the searches
+    Given I have two standard Schroedinger ChessBoards
+    When both boards play 2 auto-moves within 40 nodes with seed 3
+    Then both boards should have played the same moves
+    Then no auto-move should have searched over 40 nodes
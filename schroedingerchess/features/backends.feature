@@ -0,0 +1,28 @@
+Feature: Tests if the consistency backends agree
+
+  Scenario Outline: Replay a recorded game with both backends
+    Given I have a Schroedinger ChessBoard for each backend
+    When I replay the moves <moves> with both backends
+    Then the pseudo-legal moves should be those passing the trivial tests
+    Then the backends should agree on every move tried
+    Then the natures of all pieces at once should match those of each piece
+    Then the backends should agree on the natures of every piece
+    Then the backends should agree on the end of the game
+    Then the backends should agree on whether the king is in check, in either order
+
+    Examples: Recorded games
+      | moves                                                                                                       |
+      | e2e4 h7h6 f1a6 h6h5 a6a7 h5h4 a7a8 h4h3 a8b8 g7g6 b8c8 g6g5 c8d8 g5g4 d8e8 g4g3 e8f8 f7f6 c2c3 b7b6 d1b3 f6f5 f8g8 |
+      | h1g3 d7d6 g1h3 e8f6 a2a4 d6d5 g3e4 f8d7 e4c5 d7f8 d2d3 d8d6 c5a6 f6h5 b2b3 d6c6                             |
+      | b1c3 e8f6 b2b3 e7e5 c1b2 f8g6 g2g3 f6g4 f1g2 g6h4 d1b1 b7b6 g2f1 a7a6 f2f4 g4f2                             |
+
+  Scenario Outline: Compare the end of a recorded game with both backends
+    Given I have a Schroedinger ChessBoard for each backend
+    When both backends play the moves <moves>
+    Then the backends should agree on the end of the game
+    Then the backends should agree on whether the king is in check, in either order
+
+    Examples: Recorded games
+      | moves                                                                                                       |
+      | e2e4 a7a6 e4e5 a6a5 e5e6 a5a4 e6d7                                                                          |
+      | f1e3 c8d6 a1b3 b7b6 d2d4 a7a6 e3d5 c7c5 d5b6 g8h6 b3a5 d8b6 d4c5 d6b5 c5b6 b8e5 b6b7 a8a7 d1d6 e5h5 b2b3 e7e6 c1g5 h5f3 e2f3 f7f6 d6c7 b5a3 c7g3 e8g6 b7b8 f8g8 b8d7 g6e4 f3e4 g8c8 g3f3 e6e5 h2h4 a3c2 f3e3 f6g5 e3a7 c8f8 b1c2 g7g6 d7f8 h6g4 a7h7 |
@@ -0,0 +1,50 @@
+Feature: Tests if consistency queries are memoized
+
+  Scenario: Ask the natures of a piece twice
+    Given I have a standard Schroedinger ChessBoard with an empty cache
+    When I move piece (0,0) to (1,2)
+    When I ask the natures of piece (3,0)
+    When I ask the natures of piece (3,0)
+    Then no new query should have been solved
+
+  Scenario: Reach the same position by different move orders
+    Given I have a standard Schroedinger ChessBoard with an empty cache
+    When I move piece (0,1) to (0,2)
+    When I move piece (0,6) to (0,5)
+    When I move piece (7,1) to (7,2)
+    When I ask the natures of piece (3,0)
+    Given I have another standard Schroedinger ChessBoard sharing the cache
+    When I move piece (7,1) to (7,2)
+    When I move piece (0,6) to (0,5)
+    When I move piece (0,1) to (0,2)
+    When I ask the natures of piece (3,0)
+    Then no new query should have been solved
+
+  Scenario: Ask twice whether the game ended
+    Given I have a standard Schroedinger ChessBoard with an empty cache
+    When I move piece (4,1) to (4,3)
+    When I ask whether the game ended
+    Then the game should not be over
+    When I ask whether the game ended
+    Then no query should have been made
+
+  Scenario: Sample nature assignments on the default cached model
+    Given I have a standard Schroedinger ChessBoard
+    When I sample 4 nature assignments twice with seed 1
+    Then both samplings should give 4 distinct assignments
+
+  Scenario: Ask whether the king is in check, then whether it is not
+    Given I have a standard Schroedinger ChessBoard with an empty cache
+    When I play the moves e2e4 a7a6 e4e5 a6a5 e5e6 a5a4 e6d7
+    When piece (4,7) can only be a king
+    When I ask whether the king is in check, then whether it is not
+    Then the king should only be possibly in check
+
+  Scenario: Ask twice whether a mated player lost
+    Given I have a standard Schroedinger ChessBoard with an empty cache
+    When I play the moves f1e3 c8d6 a1b3 b7b6 d2d4 a7a6 e3d5 c7c5 d5b6 g8h6 b3a5 d8b6 d4c5 d6b5 c5b6 b8e5 b6b7 a8a7 d1d6 e5h5 b2b3 e7e6 c1g5 h5f3 e2f3 f7f6 d6c7 b5a3 c7g3 e8g6 b7b8 f8g8 b8d7 g6e4 f3e4 g8c8 g3f3 e6e5 h2h4 a3c2 f3e3 f6g5 e3a7 c8f8 b1c2 g7g6 d7f8 h6g4 a7h7
+    When I ask whether the game ended
+    Then the current player should be checkmated
+    When I ask whether the game ended
+    Then no query should have been made
+    Then the current player should be checkmated
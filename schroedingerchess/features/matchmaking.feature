@@ -0,0 +1,24 @@
+Feature: Tests the matchmaking of the server
+
+  Scenario: Players accepting either color fill the side that is short
+    Given I have a matchmaker
+    When 2 players ask for whites
+    When a player asks for any color
+    When a player asks for any color
+    Then 2 games should have started
+    Then the players asking for any color should play blacks
+
+  Scenario: Players are only matched within their rating band
+    Given I have a matchmaker with rating bands of 200
+    When a player rated 1500 asks for whites
+    When a player rated 1900 asks for blacks
+    Then 0 games should have started
+    When a player rated 1550 asks for blacks
+    Then 1 games should have started
+
+  Scenario: Thousands of players come and go
+    Given I have a matchmaker
+    When 2000 simulated players come and some leave
+    When 20000 simulated players come and some leave
+    Then no player should have been matched twice
+    Then the queue operations per player should not grow with the number of players
@@ -0,0 +1,7 @@
+Feature: Tests if worker processes find the same legal moves
+
+  Scenario: Replay a recorded game with and without worker processes
+    Given I have a Schroedinger ChessBoard with 2 worker processes and one without
+    When I replay the moves b1c3 e8f6 b2b3 e7e5 c1b2 f8g6 g2g3 f6g4 f1g2 g6h4 on both boards
+    Then both boards should find the same legal moves
+    Then both boards should find the same natures for every piece
@@ -0,0 +1,11 @@
+Feature: Tests the self-play benchmark
+
+  Scenario: Self-play games are reproducible with or without workers
+    When I play 2 self-play games of 16 plies between sunfish and random
+    When I play the same games with 2 worker processes
+    Then both runs should have played the same plies and move tests
+    Then every game should have reached the ply limit
+
+  Scenario: Self-play games ending in mate have a winner
+    When I play a self-play game of 60 plies between sunfish and random with seed 2
+    Then whites should have won after 49 plies
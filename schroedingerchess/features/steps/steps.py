@@ -1,5 +1,12 @@
 from behave import *
 from chess import *
+from consistency import FEASIBLE, INFEASIBLE, FeasibilityCache
+from matchmaking import Matchmaker, ANY_COLOR
+from selfplay import benchmark, play_game
+import sunfish
+import itertools
+from collections import deque
+import random
 
 @given("I have a standard Schroedinger ChessBoard")
 def standard_chessboard(context):
@@ -45,3 +52,356 @@ def move_black_pawn(context):
     assert context.black_pawn > 0
     move(context, 0, context.black_pawn, 0, context.black_pawn-1)
     context.black_pawn = context.black_pawn - 1
+
+@given("I have a Schroedinger ChessBoard for each backend")
+def chessboard_per_backend(context):
+    context.boards = [
+        ChessBoard(backend="pulp", cache=None, debug=True),
+        ChessBoard(
+            backend="propagation", cache=None, debug=True, memory_cap=0)
+    ]
+    context.disagreements = []
+
+def verdict(cb, x1, y1, x2, y2):
+    try:
+        return cb.test_move(x1, y1, x2, y2)
+    except IllegalMove as e:
+        return str(e)
+
+@when("I replay the moves {moves} with both backends")
+def replay_with_backends(context, moves):
+    pulp_cb, propagation_cb = context.boards
+    context.wrong_candidates = []
+    for move in moves.split():
+        candidates = pulp_cb.pseudo_legal_moves()
+        if candidates != [
+            quadruple for quadruple in itertools.product(range(8), repeat=4)
+            if pulp_cb.trivial_test_move(*quadruple) is None
+        ]:
+            context.wrong_candidates.append(pulp_cb.time)
+        for x1, y1, x2, y2 in candidates:
+            verdicts = [verdict(cb, x1, y1, x2, y2) for cb in context.boards]
+            if verdicts[0] != verdicts[1]:
+                context.disagreements.append((pulp_cb.time, (x1, y1, x2, y2)))
+        x1, y1, x2, y2 = pulp_cb.translate_move((move[:2], move[2:]))
+        for cb in context.boards:
+            cb.move(x1, y1, x2, y2, disp=False)
+
+@then("the pseudo-legal moves should be those passing the trivial tests")
+def pseudo_legal_moves(context):
+    assert context.wrong_candidates == []
+
+@then("the backends should agree on every move tried")
+def backends_agree_on_moves(context):
+    assert context.disagreements == []
+
+@then("the natures of all pieces at once should match those of each piece")
+def bulk_natures(context):
+    for cb in context.boards:
+        legal_natures = cb.legal_natures_all_pieces(update=False)
+        for c in colors:
+            for i, piece in enumerate(cb.pieces[c]):
+                assert legal_natures[c][i] == cb.all_legal_natures(piece, update=False)
+
+@then("the backends should agree on the natures of every piece")
+def backends_agree_on_natures(context):
+    pulp_cb, propagation_cb = context.boards
+    for c in colors:
+        for i in piece_numbers + promoted_numbers:
+            assert (
+                pulp_cb.all_legal_natures(pulp_cb.pieces[c][i]) ==
+                propagation_cb.all_legal_natures(propagation_cb.pieces[c][i])
+            )
+
+@when("both backends play the moves {moves}")
+def play_with_backends(context, moves):
+    for move in moves.split():
+        x1, y1, x2, y2 = context.boards[0].translate_move((move[:2], move[2:]))
+        for cb in context.boards:
+            cb.move(x1, y1, x2, y2, disp=False)
+
+@then("the backends should agree on the end of the game")
+def backends_agree_on_end_game(context):
+    pulp_cb, propagation_cb = context.boards
+    assert pulp_cb.end_game() == propagation_cb.end_game()
+
+@then("the backends should agree on whether the king is in check, in either order")
+def backends_agree_on_check(context):
+    statuses = [
+        [cb.quantum_explanation(check=check)[1] for check in order]
+        for order in [(True, False), (False, True)]
+        for cb in context.boards
+    ]
+    pulp_forward, propagation_forward, pulp_backward, propagation_backward = statuses
+    assert pulp_forward == propagation_forward == pulp_backward[::-1]
+    assert pulp_backward == propagation_backward
+
+@given("I have a standard Schroedinger ChessBoard with an empty cache")
+def chessboard_with_cache(context):
+    context.cache = FeasibilityCache(100)
+    context.cb = ChessBoard(backend="propagation", cache=context.cache)
+
+@given("I have another standard Schroedinger ChessBoard sharing the cache")
+def other_chessboard_with_cache(context):
+    context.cb = ChessBoard(backend="propagation", cache=context.cache)
+
+@when("I ask the natures of piece ({a:d},{b:d})")
+def ask_natures(context, a, b):
+    context.misses = context.cache.misses
+    context.cb.all_legal_natures(context.cb.grid[a][b], update=False)
+
+@when("I ask whether the game ended")
+def ask_end_game(context):
+    context.queries = context.cache.hits + context.cache.misses
+    context.outcome = context.cb.end_game()
+
+@then("the game should not be over")
+def game_not_over(context):
+    assert context.outcome == "Legal moves still exist"
+
+@then("the current player should be checkmated")
+def current_player_checkmated(context):
+    assert context.outcome == "Current player checkmated"
+
+@then("no query should have been made")
+def no_query(context):
+    assert context.cache.hits + context.cache.misses == context.queries
+
+@then("no new query should have been solved")
+def no_new_query(context):
+    assert context.cache.misses == context.misses
+    assert context.cache.hits > 0
+
+@when("I play the moves {moves}")
+def play_moves(context, moves):
+    for move in moves.split():
+        x1, y1, x2, y2 = context.cb.translate_move((move[:2], move[2:]))
+        context.cb.move(x1, y1, x2, y2, disp=False)
+
+@when("piece ({a:d},{b:d}) can only be a king")
+def only_king(context, a, b):
+    context.cb.grid[a][b].forbidden_natures = [
+        n for n in major_piece_natures if n != "K"
+    ]
+
+@when("I ask whether the king is in check, then whether it is not")
+def ask_check_then_no_check(context):
+    context.statuses = [
+        context.cb.quantum_explanation(check=check)[1]
+        for check in (True, False)
+    ]
+
+@then("the king should only be possibly in check")
+def only_check(context):
+    assert context.statuses == [FEASIBLE, INFEASIBLE]
+
+@given("I have a Schroedinger ChessBoard with {k:d} worker processes and one without")
+def chessboards_with_workers(context, k):
+    context.boards = [
+        ChessBoard(backend="propagation", cache=None, workers=k),
+        ChessBoard(backend="propagation", cache=None)
+    ]
+    context.legal_moves = []
+    context.add_cleanup(context.boards[0].pool.shutdown)
+
+@when("I replay the moves {moves} on both boards")
+def replay_on_both_boards(context, moves):
+    for move in moves.split():
+        context.legal_moves.append(
+            [cb.all_legal_moves() for cb in context.boards])
+        x1, y1, x2, y2 = context.boards[0].translate_move((move[:2], move[2:]))
+        for cb in context.boards:
+            cb.move(x1, y1, x2, y2, disp=False)
+
+@then("both boards should find the same legal moves")
+def same_legal_moves(context):
+    for parallel_moves, sequential_moves in context.legal_moves:
+        assert parallel_moves == sequential_moves
+
+@then("both boards should find the same natures for every piece")
+def same_natures(context):
+    parallel_cb, sequential_cb = context.boards
+    for c in colors:
+        for p, q in zip(parallel_cb.pieces[c], sequential_cb.pieces[c]):
+            assert (
+                parallel_cb.all_legal_natures(p, update=False) ==
+                sequential_cb.all_legal_natures(q, update=False)
+            )
+
+class CountingQueue(deque):
+    """Queue counting the players added to and taken from it."""
+
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    def append(self, entry):
+        self.counter[0] += 1
+        super().append(entry)
+
+    def popleft(self):
+        self.counter[0] += 1
+        return super().popleft()
+
+class CountingMatchmaker(Matchmaker):
+    """Matchmaker counting the operations on its queues."""
+
+    def __init__(self):
+        super().__init__()
+        self.operations = [0]
+
+    def queue(self, key, color):
+        if (key, color) not in self.queues:
+            self.queues[(key, color)] = CountingQueue(self.operations)
+        return self.queues[(key, color)]
+
+@given("I have a matchmaker")
+def matchmaker(context):
+    context.matchmaker = CountingMatchmaker()
+    context.matches = []
+    context.any_color = set()
+    context.players = itertools.count()
+
+@given("I have a matchmaker with rating bands of {band:d}")
+def matchmaker_with_bands(context, band):
+    matchmaker(context)
+    context.matchmaker.band = band
+
+def arrive(context, color, rating=None):
+    player_id = next(context.players)
+    match = context.matchmaker.enqueue(player_id, None, color, rating)
+    if match is not None:
+        context.matches.append(match)
+    return player_id
+
+@when("{k:d} players ask for whites")
+def ask_whites(context, k):
+    for _ in range(k):
+        arrive(context, 0)
+
+@when("a player asks for any color")
+def ask_any_color(context):
+    context.any_color.add(arrive(context, ANY_COLOR))
+
+@when("a player rated {rating:d} asks for {side}")
+def ask_with_rating(context, rating, side):
+    arrive(context, 0 if side == "whites" else 1, rating)
+
+@then("{k:d} games should have started")
+def games_started(context, k):
+    assert len(context.matches) == k
+
+@then("the players asking for any color should play blacks")
+def any_color_plays_blacks(context):
+    assert {blacks[0] for (whites, blacks) in context.matches} == context.any_color
+
+@when("{n:d} simulated players come and some leave")
+def simulated_players(context, n):
+    rng = random.Random(n)
+    start = context.matchmaker.operations[0]
+    for player_id in range(n):
+        player_id = (n, player_id)
+        match = context.matchmaker.enqueue(
+            player_id, None, rng.choice([0, 0, 1, ANY_COLOR]))
+        if match is not None:
+            context.matches.append(match)
+        if rng.random() < 0.3:
+            context.matchmaker.remove(player_id)
+    context.operations_per_player = getattr(context, "operations_per_player", [])
+    context.operations_per_player.append(
+        (context.matchmaker.operations[0] - start) / n)
+
+@then("no player should have been matched twice")
+def matched_once(context):
+    players = [player[0] for match in context.matches for player in match]
+    assert len(players) == len(set(players))
+    assert context.matchmaker.stats()["matched"] == len(players)
+
+@then("the queue operations per player should not grow with the number of players")
+def constant_operations_per_player(context):
+    # Each player is queued at most once and taken from the queue at most once
+    for operations in context.operations_per_player:
+        assert 0 < operations <= 2
+
+class RecordingSearcher(sunfish.Searcher):
+    """Searcher keeping the number of nodes of each of its searches."""
+
+    def __init__(self):
+        super().__init__()
+        self.searched_nodes = []
+
+    def search(self, pos, **budget):
+        result = super().search(pos, **budget)
+        self.searched_nodes.append(self.nodes)
+        return result
+
+@given("I have two standard Schroedinger ChessBoards")
+def two_chessboards(context):
+    context.boards = [ChessBoard(backend="propagation") for _ in range(2)]
+    for cb in context.boards:
+        cb.searcher = RecordingSearcher()
+    context.searched_nodes = []
+
+@when("both boards play {k:d} auto-moves within {nodes:d} nodes with seed {seed:d}")
+def play_auto_moves(context, k, nodes, seed):
+    for cb in context.boards:
+        for ply in range(k):
+            cb.searcher.searched_nodes = []
+            x1, y1, x2, y2 = cb.auto_move(secs=None, nodes=nodes, seed=seed + ply)
+            context.searched_nodes.append(cb.searcher.searched_nodes)
+            cb.move(x1, y1, x2, y2, disp=False)
+
+@then("both boards should have played the same moves")
+def same_moves_played(context):
+    assert context.boards[0].moves == context.boards[1].moves
+
+@then("no auto-move should have searched over {nodes:d} nodes")
+def searches_within_budget(context, nodes):
+    for samples in context.searched_nodes:
+        assert samples
+        assert sum(samples) <= nodes
+        assert max(samples) <= nodes // len(samples)
+
+@when("I play {games:d} self-play games of {plies:d} plies between {whites} and {blacks}")
+def play_self_play_games(context, games, plies, whites, blacks):
+    context.selfplay = dict(
+        games=games, whites=whites, blacks=blacks, seed=3,
+        backend="propagation", max_plies=plies, nodes=500
+    )
+    context.reports = [benchmark(**context.selfplay)]
+
+@when("I play the same games with {k:d} worker processes")
+def play_same_games_in_pool(context, k):
+    context.reports.append(benchmark(workers=k, **context.selfplay))
+
+@then("both runs should have played the same plies and move tests")
+def same_self_play_runs(context):
+    first, second = context.reports
+    for key in ["plies", "test_moves", "solver_calls_per_move", "outcomes"]:
+        assert first[key] == second[key]
+
+@then("every game should have reached the ply limit")
+def self_play_ply_limit(context):
+    report = context.reports[0]
+    assert report["plies"] == report["games"] * context.selfplay["max_plies"]
+    assert report["outcomes"] == {"ply limit": report["games"]}
+
+@when("I play a self-play game of {plies:d} plies between {whites} and {blacks} with seed {seed:d}")
+def play_self_play_game(context, plies, whites, blacks, seed):
+    context.game = play_game(
+        whites, blacks, seed, backend="propagation", max_plies=plies, nodes=300)
+
+@then("{winner} should have won after {plies:d} plies")
+def self_play_winner(context, winner, plies):
+    assert context.game["plies"] == plies
+    assert context.game["outcome"] == "{} win".format(winner)
+
+@when("I sample {k:d} nature assignments twice with seed {seed:d}")
+def sample_natures_twice(context, k, seed):
+    context.samplings = [context.cb.nature_samples(k, seed) for _ in range(2)]
+
+@then("both samplings should give {k:d} distinct assignments")
+def distinct_samples(context, k):
+    for samples in context.samplings:
+        assert len(samples) == k
+    assert context.samplings[0] == context.samplings[1]
@@ -15,6 +15,8 @@ import time
 
 FRAME_PER_SECOND = 10
 CONNECTION_WAITING_TIME = 10  # seconds
+RECONNECTION_ATTEMPTS = 3
+RECONNECTION_DELAY = 2  # seconds
 
 
 class GameEngine():
@@ -107,23 +109,20 @@ class TwoPlayersOnOneBoard(GameEngine):
     @inlineCallbacks
     def updateLightBoard(self):
         nb = self.validMovesCounter
-        for col in [0, 1]:
-            for i, piece in enumerate(self.chessBoard.pieces[col]):
-                if nb == self.validMovesCounter:
-                    self.updateDeferred = Deferred()
-                    self.updateDeferred.addCallback(self.chessBoard.all_legal_natures)
-                    self.updateDeferred.addErrback(log.err)  # DEBUG
-                    reactor.callLater(0, self.updateDeferred.callback, piece)
-                    natures = yield self.updateDeferred
-                    if nb == self.validMovesCounter:
-                        color = piece.color
-                        position = piece.position
-                        pieceIndex = i + col * 24
-                        self.lightBoard.setPiece(pieceIndex, color, position, natures)
-                        if (piece.position is not None) and (piece.position is not False):
-                            self.makeDisplayDrawBoard()
-                        elif (piece.position is False):
-                            self.display.updatePane()
+        self.updateDeferred = Deferred()
+        self.updateDeferred.addCallback(self.chessBoard.legal_natures_all_pieces)
+        self.updateDeferred.addErrback(log.err)  # DEBUG
+        reactor.callLater(0, self.updateDeferred.callback, True)
+        legal_natures = yield self.updateDeferred
+        if nb == self.validMovesCounter:
+            for col in [0, 1]:
+                for i, piece in enumerate(self.chessBoard.pieces[col]):
+                    color = piece.color
+                    position = piece.position
+                    pieceIndex = i + col * 24
+                    self.lightBoard.setPiece(pieceIndex, color, position, legal_natures[col][i])
+            self.makeDisplayDrawBoard()
+            self.display.updatePane()
 
     def moveTask(self, mov):
         x1, y1, x2, y2 = mov[0], mov[1], mov[2], mov[3]
@@ -173,26 +172,53 @@ class OnePlayerOnNetwork(GameEngine):
             self.display.flipDisplay(True)
 
         self.loopingCall = gameEngine.loopingCall
+        self.host, self.port = host, int(port)
+        self.resumeToken = None # token to resume the game after a disconnection
+        self.reconnections = 0 # attempts to resume since the last disconnection
+        self.connect()
+        self.display.addMessage("Connecting to remote server...")
+
+    def connect(self):
+        """ Connects a new protocol to the server, resuming the game if there is a token."""
         self.protocol = ChessClientProtocol(self)
-
-        point = TCP4ClientEndpoint(reactor, host, int(port))  # connection point
+        point = TCP4ClientEndpoint(reactor, self.host, self.port)  # connection point
         try:
             attempt = connectProtocol(point, self.protocol)
             attempt.addErrback(self.connectionFailed)
             attempt.addTimeout(CONNECTION_WAITING_TIME, reactor,
                                onTimeoutCancel=self.connectionFailed)
-            self.display.addMessage("Connecting to remote server...")
         except:
             self.connectionFailed()
 
-    def handleInit(self):
+    def handleInit(self, resumeToken):
         self.display.addMessage("Connection established.")
-        self.display.addMessage("Waiting for an opponent...")
-
-    def handleReady(self):
+        if self.reconnections == 0:
+            self.resumeToken = resumeToken
+            self.display.addMessage("Waiting for an opponent...")
+
+    def handleReady(self, color=None):
+        if color is not None and color != self.color:
+            self.color = color
+            self.display.flipDisplay(color == 1)
         self.display.addMessage("Found an opponent. White begins...")
         self.turn = 0
 
+    def handleResumed(self, resumeToken, turn):
+        """ Continues the game the server kept during the disconnection """
+        self.resumeToken = resumeToken
+        self.reconnections = 0
+        self.turn = turn
+        self.display.addMessage("Game resumed.")
+
+    def tryToResume(self):
+        """ Schedules an attempt to resume the game, if one is left """
+        if self.resumeToken is None or self.turn == -1 or self.reconnections >= RECONNECTION_ATTEMPTS:
+            return False
+        self.reconnections += 1
+        self.display.addMessage("Trying to resume the game...")
+        reactor.callLater(RECONNECTION_DELAY, self.connect)
+        return True
+
     def moveTask(self, x1, y1, x2, y2):
         if self.turn != self.color:
             self.display.addMessage("Trying to move out of turn")
@@ -228,8 +254,18 @@ class OnePlayerOnNetwork(GameEngine):
         self.makeDisplayDrawBoard()
         # print("cb.move({},{},{},{})".format(x1, y1, x2, y2))
 
-    def handleUpdateBoard(self, description):
+    def handleUpdateBoard(self, description, version):
         self.lightBoard.unwrap(description)
+        self.lightBoard.version = version
+        self.makeDisplayDrawBoard()
+
+    def handleBoardDelta(self, description, base, version):
+        """ Applies the pieces changed since the base version, or asks for the whole board """
+        if self.lightBoard.version != base:
+            self.protocol.sendMessage({"type": "lightboard-request"})
+            return
+        self.lightBoard.applyDelta(description)
+        self.lightBoard.version = version
         self.makeDisplayDrawBoard()
 
     def handleChecks(self, description):
@@ -239,14 +275,23 @@ class OnePlayerOnNetwork(GameEngine):
         self.makeDisplayDrawCheckMates(description)
 
     def connectionFailed(self, *kwargs):
+        if self.reconnections > 0:
+            self.handleDisconnection("The game could not be resumed")
+            return
         self.display.setMenuMode()
         self.display.addMessage("The server could not be reached.")
 
-    def handleDisconnection(self, description):
+    def handleDisconnection(self, description, final=False):
         # if self.display is None:
             # return
+        if self.display.gameEngine is not self:
+            return # already back to the menu
+        if final:
+            self.resumeToken = None
         self.display.addMessage("Disconnected from server")
         self.display.addMessage(description.__str__())
+        if self.tryToResume():
+            return
         self.suspend()
         self.display.gameEngine = GameEngine()
         self.display.gameEngine.startFromEngine(self)
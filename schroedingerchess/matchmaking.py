@@ -0,0 +1,135 @@
+"""Queues of the players waiting for an opponent on the server."""
+
+import time
+from collections import deque
+
+# Color asked by the players who accept either side
+ANY_COLOR = None
+
+
+class Matchmaker():
+    """
+    Pairs waiting players as they arrive, oldest first.
+
+    Each rating band holds one queue per asked color. Players leaving the
+    queue are only marked as gone and skipped when they reach the front, so
+    that arriving, matching and leaving all take constant time.
+    """
+
+    def __init__(self, band=None, clock=time.monotonic):
+        """
+        Prepare empty queues.
+
+        :param band: Width of the rating bands players are matched within,
+            or None to match players whatever their ratings.
+        :param clock: Function giving the current time in seconds.
+        """
+        self.band = band
+        self.clock = clock
+        self.queues = {}
+        self.entries = {}
+        self.matched = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def bandOf(self, rating):
+        """Key of the queues of a rating."""
+        if self.band is None or rating is None:
+            return None
+        return int(rating // self.band)
+
+    def queue(self, key, color):
+        """Queue of the players of a band asking for a color."""
+        if (key, color) not in self.queues:
+            self.queues[(key, color)] = deque()
+        return self.queues[(key, color)]
+
+    def pop(self, key, color):
+        """Remove and return the oldest player still waiting in a queue."""
+        queue = self.queue(key, color)
+        while queue:
+            entry = queue.popleft()
+            if self.entries.get(entry[0]) is entry:
+                del self.entries[entry[0]]
+                self.record(entry)
+                return entry
+        return None
+
+    def record(self, entry):
+        """Account for the time a matched player waited."""
+        wait = self.clock() - entry[3]
+        self.matched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def enqueue(self, player_id, client, color=ANY_COLOR, rating=None):
+        """
+        Match an arriving player, or make them wait.
+
+        :param player_id: Identifier of the player.
+        :param client: Object standing for the player, returned in matches.
+        :param color: 0 for whites, 1 for blacks, anything else for either.
+        :return: ((whites_id, whites_client), (blacks_id, blacks_client)) if
+            the player found an opponent, None otherwise.
+        """
+        if color not in (0, 1):
+            color = ANY_COLOR
+        key = self.bandOf(rating)
+        entry = (player_id, client, color, self.clock())
+        if color == ANY_COLOR:
+            # Take the side of the oldest player waiting in the band
+            waiting = [
+                other for other in (
+                    self.peek(key, 0), self.peek(key, 1),
+                    self.peek(key, ANY_COLOR)
+                ) if other is not None
+            ]
+            if waiting:
+                other = min(waiting, key=lambda e: e[3])
+                other = self.pop(key, other[2])
+                self.record(entry)
+                if other[2] == 1:
+                    return self.pair(entry, other)
+                return self.pair(other, entry)
+        else:
+            other = self.pop(key, 1 - color)
+            if other is None:
+                other = self.pop(key, ANY_COLOR)
+            if other is not None:
+                self.record(entry)
+                if color == 0:
+                    return self.pair(entry, other)
+                return self.pair(other, entry)
+        self.entries[player_id] = entry
+        self.queue(key, color).append(entry)
+        return None
+
+    def peek(self, key, color):
+        """Oldest player still waiting in a queue, left in it."""
+        queue = self.queue(key, color)
+        while queue and self.entries.get(queue[0][0]) is not queue[0]:
+            queue.popleft()
+        return queue[0] if queue else None
+
+    def pair(self, whites, blacks):
+        """Identifiers and clients of a match."""
+        return (whites[0], whites[1]), (blacks[0], blacks[1])
+
+    def remove(self, player_id):
+        """Forget a waiting player, returning whether they were waiting."""
+        return self.entries.pop(player_id, None) is not None
+
+    def __contains__(self, player_id):
+        return player_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Numbers of waiting and matched players, and their waits in seconds."""
+        return {
+            "waiting": len(self.entries),
+            "matched": self.matched,
+            "mean_wait": self.total_wait / self.matched if self.matched else 0.,
+            "max_wait": self.max_wait
+        }
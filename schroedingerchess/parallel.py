@@ -0,0 +1,172 @@
+"""Legality checks of a ChessBoard spread over a pool of processes."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import chess
+import sunfish
+
+# Plies played since the history was shipped to the workers after which a
+# new pool receives the whole history again, instead of longer deltas
+REBASE_PLIES = 40
+
+# Replica of the board history in a worker process
+replica = None
+backend = None
+base_moves = []
+applied_moves = []
+# Sunfish searcher of the worker, whose tables are reused
+searcher = None
+
+
+class ReplicaMissing(Exception):
+    """Raised by a worker asked to run a task before getting the history."""
+
+
+def init_worker(board_backend, moves):
+    """Build the replica from the history shipped to a new worker."""
+    global backend, base_moves
+    backend = board_backend
+    base_moves = list(moves)
+    rebuild([])
+
+
+def rebuild(delta):
+    """Replay the shipped history and the delta on a new replica."""
+    global replica, applied_moves
+    replica = chess.ChessBoard(backend=backend)
+    for (x1, y1, x2, y2) in base_moves + list(delta):
+        replica.perform_move(x1, y1, x2, y2, {})
+    applied_moves = list(delta)
+
+
+def sync(delta):
+    """Bring the replica to the moves played since the history was shipped."""
+    global applied_moves
+    delta = list(delta)
+    if delta[:len(applied_moves)] != applied_moves:
+        rebuild(delta)
+        return
+    for (x1, y1, x2, y2) in delta[len(applied_moves):]:
+        replica.perform_move(x1, y1, x2, y2, {})
+    applied_moves = delta
+
+
+def run(function, history, delta, tasks):
+    """
+    Run a task in a worker, building the replica first from the history
+    if the worker has none yet, in which case the history must be given.
+    """
+    if backend is None:
+        if history is None:
+            raise ReplicaMissing()
+        init_worker(*history)
+    return function(delta, tasks)
+
+
+def check_moves(delta, moves):
+    """List the legal moves among candidates, after syncing the replica."""
+    sync(delta)
+    legal_moves = []
+    for (x1, y1, x2, y2) in moves:
+        try:
+            replica.test_move(x1, y1, x2, y2)
+            legal_moves.append((x1, y1, x2, y2))
+        except chess.IllegalMove:
+            pass
+    return legal_moves
+
+
+def check_natures(delta, couples):
+    """List the legal (c, i, n) among candidates, after syncing the replica."""
+    sync(delta)
+    return [
+        (c, i, n) for (c, i, n) in couples
+        if replica.is_legal_nature(replica.pieces[c][i], n)
+    ]
+
+
+def search_positions(delta, tasks):
+    """Search the best sunfish move of each (position, budget) task."""
+    global searcher
+    if searcher is None:
+        searcher = sunfish.Searcher()
+    return [searcher.search(pos, **budget) for (pos, budget) in tasks]
+
+
+class LegalityPool():
+    """
+    Process pool checking legality on replicas of a board history.
+
+    Each worker receives the history once, along with its first task,
+    and every other task only carries the moves played since then.
+    """
+
+    def __init__(self, board, workers=None):
+        """
+        Prepare a pool, started on first use.
+
+        :param board: ChessBoard whose history is replicated.
+        :param workers: Number of processes, one per core by default.
+        """
+        self.board = board
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+        self.base = 0
+        self.history = None
+        # Futures not done yet, cancelled when the pool stops
+        self.pending = set()
+
+    def delta(self):
+        """List the moves played since the history was shipped."""
+        moves = self.board.moves
+        if (
+            self.executor is None or
+            len(moves) < self.base or
+            len(moves) - self.base > REBASE_PLIES
+        ):
+            self.shutdown()
+            self.base = len(moves)
+            self.history = (self.board.backend, moves[:])
+            self.executor = ProcessPoolExecutor(self.workers)
+        return tuple(moves[self.base:])
+
+    def submit(self, function, history, delta, tasks):
+        """Run function on tasks in a worker, keeping track of the future."""
+        future = self.executor.submit(run, function, history, delta, tasks)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    def stream(self, function, tasks):
+        """Yield the results of function on chunks of tasks as they end."""
+        delta = self.delta()
+        size = max(1, len(tasks) // (4 * self.workers))
+        futures = {
+            self.submit(function, None, delta, tasks[k:k + size]):
+            tasks[k:k + size]
+            for k in range(0, len(tasks), size)
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except ReplicaMissing:
+                    # The worker starts with this chunk, along with the history
+                    retry = self.submit(
+                        function, self.history, delta, futures[future])
+                    futures[retry] = futures[future]
+                    results = retry.result()
+                for result in results:
+                    yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self.executor is not None:
+            for future in list(self.pending):
+                future.cancel()
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,189 @@
+"""Headless games between auto-move policies, measuring the throughput."""
+
+import argparse
+import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from chess import ChessBoard, IllegalMove
+from consistency import CACHE_SIZE, CachedModel, FeasibilityCache, backends
+
+# Plies after which a game is stopped
+MAX_PLIES = 200
+
+# Nodes of the sunfish searches, a node budget keeping games reproducible
+SUNFISH_NODES = 2000
+
+# Outcomes of the games, by verdict of ChessBoard.end_game
+outcomes = {
+    "Stalemate": "stalemate",
+    "Result unclear": "unclear"
+}
+
+
+class CountingModel():
+    """Consistency model counting the problems it solves."""
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+
+    def push(self, constraints):
+        self.model.push(constraints)
+
+    def pop(self):
+        self.model.pop()
+
+    def prune(self, constraints=()):
+        return self.model.prune(constraints)
+
+    def solve(self, constraints=(), preferred=None):
+        self.calls += 1
+        return self.model.solve(constraints, preferred)
+
+
+class TimedBoard(ChessBoard):
+    """Chess board recording the latency of its move tests."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+        # Only the queries missing from the cache reach the solver
+        if isinstance(self.model, CachedModel):
+            self.solver = self.model.model = CountingModel(self.model.model)
+        else:
+            self.solver = self.model = CountingModel(self.model)
+
+    def test_move(self, x1, y1, x2, y2, full_result=False):
+        start = time.perf_counter()
+        try:
+            return super().test_move(x1, y1, x2, y2, full_result)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def random_policy(board, seed, nodes):
+    """First legal move in a random order, None if there is none."""
+    return next(board.all_legal_moves_gen(seed=seed), None)
+
+
+def sunfish_policy(board, seed, nodes):
+    """Legal move suggested by sunfish, None if there is none."""
+    try:
+        return board.auto_move(secs=None, nodes=nodes, seed=seed)
+    except IllegalMove:
+        return None
+
+
+policies = {
+    "random": random_policy,
+    "sunfish": sunfish_policy
+}
+
+
+def play_game(whites, blacks, seed, backend="pulp", max_plies=MAX_PLIES,
+              nodes=SUNFISH_NODES):
+    """
+    Play a game between two policies on a board with a cache of its own.
+
+    Returns the plies played, the outcome, the seconds taken, the solver
+    calls and the latencies of the move tests.
+    """
+    board = TimedBoard(backend=backend, cache=FeasibilityCache(CACHE_SIZE))
+    players = [policies[whites], policies[blacks]]
+    rng = np.random.RandomState(seed)
+    outcome = "ply limit"
+    start = time.perf_counter()
+    while board.time < max_plies:
+        move = players[board.time % 2](board, rng.randint(2 ** 31), nodes)
+        if move is None:
+            verdict = board.end_game()
+            if verdict == "Current player checkmated":
+                outcome = "blacks win" if board.time % 2 == 0 else "whites win"
+            else:
+                outcome = outcomes.get(verdict, verdict)
+            break
+        board.move(*move, disp=False)
+    return {
+        "plies": board.time,
+        "outcome": outcome,
+        "seconds": time.perf_counter() - start,
+        "solver_calls": board.solver.calls,
+        "latencies": board.latencies
+    }
+
+
+def benchmark(games=10, whites="sunfish", blacks="random", workers=None,
+              seed=0, backend="pulp", max_plies=MAX_PLIES, nodes=SUNFISH_NODES):
+    """
+    Play games between two policies and summarize their throughput.
+
+    Game k is played with seed + k, so that a run is reproducible whether
+    the games are played one after the other or by a pool of worker
+    processes (0 for one per core).
+    """
+    args = [
+        (whites, blacks, seed + k, backend, max_plies, nodes)
+        for k in range(games)
+    ]
+    start = time.perf_counter()
+    if workers is None:
+        results = [play_game(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(workers or None) as executor:
+            results = list(executor.map(play_game, *zip(*args)))
+    elapsed = time.perf_counter() - start
+    plies = sum(r["plies"] for r in results)
+    latencies = [t for r in results for t in r["latencies"]]
+    median, p99 = (
+        1000 * np.percentile(latencies, [50, 99]) if latencies else (0., 0.)
+    )
+    return {
+        "games": games,
+        "whites": whites,
+        "blacks": blacks,
+        "workers": workers,
+        "seed": seed,
+        "backend": backend,
+        "plies": plies,
+        "seconds": elapsed,
+        "moves_per_sec": plies / elapsed if elapsed else 0.,
+        "solver_calls_per_move": (
+            sum(r["solver_calls"] for r in results) / plies if plies else 0.
+        ),
+        "test_moves": len(latencies),
+        "test_move_median_ms": float(median),
+        "test_move_p99_ms": float(p99),
+        "outcomes": dict(Counter(r["outcome"] for r in results))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--whites", choices=sorted(policies), default="sunfish")
+    parser.add_argument("--blacks", choices=sorted(policies), default="random")
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="worker processes playing the games, 0 for one per core")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=sorted(backends), default="pulp")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--nodes", type=int, default=SUNFISH_NODES)
+    parser.add_argument(
+        "--output", type=argparse.FileType("w"), default="-",
+        help="file of the JSON report, the pulp solver logging to stdout")
+    args = parser.parse_args()
+    report = benchmark(
+        args.games, args.whites, args.blacks, args.workers, args.seed,
+        args.backend, args.max_plies, args.nodes
+    )
+    json.dump(report, args.output, indent=2)
+    args.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
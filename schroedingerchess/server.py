@@ -1,17 +1,34 @@
-from twisted.internet.protocol import Protocol, Factory
+import secrets
+import sys
+import threading
+
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import Int32StringReceiver
 from twisted.internet import reactor
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, DeferredLock, succeed
+from twisted.internet.threads import deferToThread
 
 from chess import ChessBoard, LightBoard, IllegalMove
+from matchmaking import Matchmaker
+from shards import ShardPool, move_task, end_game_task, pieces_task, ponder_task
+from wire import encode, decode
+
+# Bytes of full bitboards each game keeps for its most recent plies
+HISTORY_MEMORY_CAP = 16 * 1024
+
+# Seconds a game waits for a disconnected player before ending
+DISCONNECT_GRACE_PERIOD = 30
 
-import json
-import time
+# Most search budget of an auto-move: secs (soft deadline), hard (hard
+# deadline), nodes and depth, as in ChessBoard.auto_move
+AUTO_MOVE_LIMITS = {"secs": 1}
 
 
-class ChessServerProtocol(Protocol):
+class ChessServerProtocol(Int32StringReceiver):
     """
     Class to handles the communication protocol with a game client.
+    Each message is a JSON object prefixed by its length on 4 bytes.
     """
 
     def __init__(self):
@@ -19,6 +36,8 @@ class ChessServerProtocol(Protocol):
         self.game_id = None
         self.game = None
         self.color = None
+        self.binary = False
+        self.token = secrets.token_urlsafe(16)
 
     def connectionMade(self):
         """
@@ -32,6 +51,7 @@ class ChessServerProtocol(Protocol):
         msg = {"type": "greetings"}
         msg["player_id"] = self.player_id
         msg["greetings"] = "looking forward hearing from you"
+        msg["resume_token"] = self.token
         self.sendMessage(msg)
 
         self.state = "WAITING_FOR_GREETINGS"
@@ -41,7 +61,7 @@ class ChessServerProtocol(Protocol):
         Sends a message to the client.
         :param msg: A dictionary representing a message.
         """
-        self.transport.write(json.dumps(msg).encode())
+        self.sendString(encode(msg, self.binary))
 
     def sendMessageToAll(self, msg):
         """
@@ -63,39 +83,56 @@ class ChessServerProtocol(Protocol):
         else:
             raise RuntimeError("trying to send a message when the game is not created / over")
 
-    def dataReceived(self, data):
-        """
-        Handles the reception of data by the server
-        :param data: A byte representing a JSON-encoded object (default encoding UTF-8)
-        """
-        # msg = json.loads(data.decode())
-        messages = self.split_messages(data)
-        update = False
-
-        for msg_json in messages:
-            msg = json.loads(msg_json)
-
-            if self.state == "GREETING":
-                raise RuntimeError("Should no happen.")
-            elif self.state == "WAITING_FOR_GREETINGS":
-                if msg["type"] == "player-info":
-                    self.handleGreetings(msg)
-            elif self.state == "PLAYING":
-                if msg["type"] == "move":
-                    self.handleMove(msg)
-                if msg["type"] == "automove":
-                    self.handleMove(msg, auto=True)
-                elif msg["type"] == "chat":
-                    self.sendMessageToOther({"type": "chat", "content": msg["content"]})
-                elif msg["type"] == "endgame":
-                    self.handleEndGame(msg["color"])
-            else:
-                self.refuseMessage(msg)
-            # TODO : reduce lightboard update delay
+    def stringReceived(self, data):
+        """
+        Handles the reception of a message by the server
+        :param data: Bytes of a JSON-encoded object (default encoding UTF-8) or of a binary message
+        """
+        msg = decode(data)
+
+        if self.state == "GREETING":
+            raise RuntimeError("Should no happen.")
+        elif self.state == "WAITING_FOR_GREETINGS":
+            if msg["type"] == "player-info":
+                self.handleGreetings(msg)
+        elif self.state == "PLAYING":
+            if msg["type"] == "move":
+                self.handleMove(msg)
+            if msg["type"] == "automove":
+                self.handleMove(msg, auto=True)
+            elif msg["type"] == "chat":
+                self.sendMessageToOther({"type": "chat", "content": msg["content"]})
+            elif msg["type"] == "endgame":
+                self.handleEndGame(msg["color"])
+            elif msg["type"] == "lightboard-request":
+                self.game.sendSnapshot(self.game.colorOf(self))
+        else:
+            self.refuseMessage(msg)
 
     def handleGreetings(self, msg):
+        if "binary" in msg.get("formats", []):
+            self.sendMessage({"type": "format", "format": "binary"})
+            self.binary = True
+        if msg.get("resume_token") is not None:
+            self.resume(msg["resume_token"])
+            return
         self.color = msg["color"]
-        self.factory.assignColor(self.player_id, self.color)
+        self.factory.assignColor(self.player_id, self.color, msg.get("rating"))
+
+    def resume(self, token):
+        """
+        Reattaches the client to the game it was disconnected from.
+        :param token: Resume token the client received in its first greetings.
+        """
+        game, color = self.factory.sessions.get(token, (None, None))
+        if game is None or color not in game.absent:
+            self.sendMessage({"type": "disconnection", "description": "The game could not be resumed"})
+            self.disconnect()
+            return
+        self.factory.removePlayerFromWaitingList(self.player_id)
+        self.token = token
+        game.reattach(self, color)
+        print("Player {} resumed game {}".format(self.player_id, game.game_id))
 
     def refuseMessage(self, msg):
         """
@@ -105,24 +142,43 @@ class ChessServerProtocol(Protocol):
         self.sendMessage({"type": "illegal-request", "request": msg})
 
     def handleMove(self, msg, auto=False):
-        try:
-            player = msg["color"]
-            if auto:
-                move = self.game.autoMove()
-            else:
-                move = msg["description"]
-            x1, y1, x2, y2 = [int(x) for x in move]
-            self.game.move(x1, y1, x2, y2, player)
-            msg = {"type": "move", "description": (x1, y1, x2, y2)}
-            self.sendMessageToAll(msg)
-            self.game.updateLightBoard()
-        except IllegalMove as e:
-            msg = {"type": "illegal-move", "description": str(e)}
-            self.sendMessage(msg)
+        """
+        Performs a move off the reactor and notifies the players.
+        :param msg: A dictionary representing a move or automove message.
+        :param auto: Whether the server chooses the move.
+        """
+        player = msg["color"]
+        if auto:
+            budget = self.factory.autoMoveBudget(msg.get("budget", {}))
+            d = self.game.autoMove(player, budget)
+        else:
+            x1, y1, x2, y2 = [int(x) for x in msg["description"]]
+            d = self.game.move(x1, y1, x2, y2, player)
+        d.addCallbacks(self.moveAccepted, self.moveRefused)
+
+    def moveAccepted(self, move):
+        """
+        Notifies both players of a performed move.
+        :param move: The performed move (x1, y1, x2, y2).
+        """
+        if self.game is None:
+            return
+        msg = {"type": "move", "description": move}
+        self.sendMessageToAll(msg)
+        self.game.updateLightBoard()
+
+    def moveRefused(self, failure):
+        """
+        Notifies the player of an illegal move.
+        :param failure: The failure raised by the move.
+        """
+        failure.trap(IllegalMove)
+        msg = {"type": "illegal-move", "description": failure.getErrorMessage()}
+        self.sendMessage(msg)
 
     def handleEndGame(self, color):
         if self.game is not None:
-            reactor.callLater(0, self.game.checkEnd, color)
+            self.game.checkEnd(color)
 
     def connectionLost(self, reason):
         """
@@ -132,31 +188,14 @@ class ChessServerProtocol(Protocol):
         if self.game is None:
             self.factory.removePlayerFromWaitingList(self.player_id)
         else:
-            # Disconnect other player and remove the game
-            self.sendMessageToOther({"type": "chat", "content": "Other player disconnected"})
-            time.sleep(0.5)
-            self.game.disconnectPlayers()
-            self.factory.removeGame(self.game_id)
+            # The game ends unless the player comes back in time
+            self.game.playerLeft(self)
         print("Player {} disconnected".format(self.player_id))
 
     def disconnect(self):
         """ Disconnect current player / protocol """
         self.transport.loseConnection()
 
-    def split_messages(self, data):
-        messages = []
-        split = data.decode().split("}{")
-        if len(split) == 1:
-            return split
-        for i, sp in enumerate(split):
-            m = sp
-            if i > 0:
-                m = "{" + m
-            if i < len(split)-1:
-                m = m + "}"
-            messages.append(m)
-        return messages
-
 
 class ChessServer(Factory):
     """
@@ -166,59 +205,81 @@ class ChessServer(Factory):
     # This will be used by the default buildProtocol to create new protocols:
     protocol = ChessServerProtocol
 
-    def __init__(self):
+    def __init__(self, gracePeriod=DISCONNECT_GRACE_PERIOD, ratingBand=None, shards=0, autoMoveLimits=AUTO_MOVE_LIMITS, ponder=False):
         """
         Constructor.
+        :param gracePeriod: Seconds a game waits for a disconnected player.
+        :param ratingBand: Width of the rating bands players are matched within, None to ignore ratings.
+        :param shards: Number of worker processes holding the chess boards, 0 to keep them in this process.
+        :param autoMoveLimits: Most search budget of an auto-move, with at least one of secs, hard, nodes and depth.
+        :param ponder: Whether games prepare the moves of the player in turn while the board is idle.
         """
+        self.gracePeriod = gracePeriod
+        self.ponder = ponder
+        self.autoMoveLimits = autoMoveLimits
+        self.shards = ShardPool(shards, HISTORY_MEMORY_CAP) if shards else None
         self.games = {}  # list of games
-        self.waitingBlackPlayers = ([], {})  # waiting white players
-        self.waitingWhitePlayers = ([], {})  # waiting black players
-        self.waitingPlayers = {}  # list of waiting players
+        self.sessions = {}  # (game, color) of each resume token
+        self.matchmaker = Matchmaker(ratingBand)  # players waiting for an opponent
+        self.waitingPlayers = {}  # players waiting for their greetings
         self.gameIndex = 0  # total number of games ever launched
         self.playerIndex = 0  # total number of players ever connected
 
+    def stopFactory(self):
+        if self.shards is not None:
+            self.shards.shutdown()
+
+    def autoMoveBudget(self, requested):
+        """
+        Caps the search budget a player asks for an auto-move.
+        :param requested: Dictionary of the secs, hard, nodes or depth asked.
+        :return: The budget of the search, within the limits of the server.
+        """
+        budget = {}
+        for key in ["secs", "hard", "nodes", "depth"]:
+            values = [self.autoMoveLimits.get(key)]
+            value = requested.get(key)
+            if isinstance(value, (int, float)) and value > 0:
+                values.append(int(value) if key in ["nodes", "depth"] else value)
+            values = [v for v in values if v is not None]
+            budget[key] = min(values) if values else None
+        return budget
+
     def addWaitingPlayer(self, client):
         self.waitingPlayers[self.playerIndex] = client
         self.playerIndex += 1
         return self.playerIndex - 1
 
-    def assignColor(self, player_id, color):
+    def assignColor(self, player_id, color, rating=None):
+        """
+        Queues a greeted player, starting a game if an opponent is waiting.
+        :param color: 0 for whites, 1 for blacks, anything else for either.
+        :param rating: Rating of the player, used when matching within rating bands.
+        """
         client = self.waitingPlayers.pop(player_id)
-        if color == 0:
-            self.waitingWhitePlayers[0].append(player_id)
-            self.waitingWhitePlayers[1][player_id] = client
-        elif color == 1:
-            self.waitingBlackPlayers[0].append(player_id)
-            self.waitingBlackPlayers[1][player_id] = client
-        else:
-            if len(self.waitingBlackPlayers) < len(self.waitingWhitePlayers):
-                self.waitingWhitePlayers[0].append(player_id)
-                self.waitingBlackPlayers[1][player_id] = client
-            else:
-                self.waitingWhitePlayers[0].append(player_id)
-                self.waitingWhitePlayers[1][player_id] = client
-        self.tryToMatchPlayers()
-
-    def tryToMatchPlayers(self):
-        while len(self.waitingBlackPlayers[0]) >= 1 and len(self.waitingWhitePlayers[0]) >= 1:
-            whites_id = self.waitingWhitePlayers[0].pop(0)
-            blacks_id = self.waitingBlackPlayers[0].pop(0)
-            whites_client = self.waitingWhitePlayers[1].pop(whites_id)
-            blacks_client = self.waitingBlackPlayers[1].pop(blacks_id)
-            game = Game(whites_client, blacks_client, self.gameIndex)
-            self.games[self.gameIndex] = game
-            print("Matched player {} and {} into game {}".format(whites_id, blacks_id, self.gameIndex))
-            self.gameIndex += 1
+        match = self.matchmaker.enqueue(player_id, client, color, rating)
+        if match is not None:
+            self.startGame(*match)
+
+    def startGame(self, whites, blacks):
+        """
+        Starts a game between two matched players.
+        :param whites: (player_id, client) of the whites.
+        :param blacks: (player_id, client) of the blacks.
+        """
+        (whites_id, whites_client), (blacks_id, blacks_client) = whites, blacks
+        game = Game(whites_client, blacks_client, self.gameIndex, self, self.shards, self.ponder)
+        self.games[self.gameIndex] = game
+        self.sessions[whites_client.token] = (game, 0)
+        self.sessions[blacks_client.token] = (game, 1)
+        print("Matched player {} and {} into game {}".format(whites_id, blacks_id, self.gameIndex))
+        self.gameIndex += 1
 
     def removePlayerFromWaitingList(self, player_id):
         if player_id in self.waitingPlayers:
             del self.waitingPlayers[player_id]
-        elif player_id in self.waitingWhitePlayers[0]:
-            self.waitingWhitePlayers[0].remove(player_id)
-            del self.waitingWhitePlayers[1][player_id]
-        elif player_id in self.waitingBlackPlayers[0]:
-            self.waitingBlackPlayers[0].remove(player_id)
-            del self.waitingBlackPlayers[1][player_id]
+        else:
+            self.matchmaker.remove(player_id)
 
     def removeGame(self, game_id):
         try:
@@ -234,8 +295,9 @@ class Game:
     Class to represent a game instance.
     """
 
-    def __init__(self, whites, blacks, gameIndex):
+    def __init__(self, whites, blacks, gameIndex, factory, shards=None, pondering=False):
         self.game_id = gameIndex
+        self.factory = factory
         self.validMovesCounter = 0
         self.white = whites
         self.white.game_id = self.game_id
@@ -243,52 +305,276 @@ class Game:
         self.black = blacks
         self.black.game_id = self.game_id
         self.black.game = self
-        self.chessBoard = ChessBoard()
         self.lightBoard = LightBoard()
+        # Light board each player has, updated along with the sent messages
+        self.sentBoards = {0: self.lightBoard.copy(), 1: self.lightBoard.copy()}
+        # Tasks on the chess board run in threads, one at a time
+        self.lock = DeferredLock()
+        # Number of light board updates requested, only the last one is sent
+        self.refreshes = 0
+        # Scheduled ends of the game, by color of the disconnected player
+        self.absent = {}
+        self.over = False
+        # Whether idle boards prepare the moves of the player in turn, and the
+        # flag stopping them when a player's task arrives, set here and read
+        # by the tasks
+        self.pondering = pondering
+        self.ponderStop = threading.Event()
+        # Players' tasks waiting for the lock while pondering
+        self.playerTasks = 0
+        # The chess board lives in a worker process when the server has
+        # shards, its tasks waiting for it to start
+        self.shards = shards
+        self.chessBoard = None
+        if shards is None:
+            self.useLocalBoard()
+        else:
+            self.lock.run(self.openBoard)
         self.notifyReady()
+        self.ponder(self.validMovesCounter)
 
     def notifyReady(self):
-        self.sendMessageToAll({"type": "status", "status": "ready"})
+        # Players who accepted either color learn which one they got
+        self.white.color = 0
+        self.black.color = 1
+        self.sendMessageTo({"type": "status", "status": "ready", "color": 0}, 0)
+        self.sendMessageTo({"type": "status", "status": "ready", "color": 1}, 1)
+        self.sendSnapshot(0)
+        self.sendSnapshot(1)
         self.white.state = "PLAYING"
         self.black.state = "PLAYING"
 
+    def openBoard(self):
+        """
+        Starts the chess board in a worker process, or in this process if no worker can hold it.
+        :return: A Deferred firing once the board is ready.
+        """
+        d = self.shards.open(self.game_id)
+        d.addCallbacks(self.boardOpened, self.boardFailed)
+        return d
+
+    def boardOpened(self, _):
+        self.ponderStop = self.shards.stop(self.game_id)
+
+    def boardFailed(self, failure):
+        print("Game {} keeps its board in the server: {}".format(self.game_id, failure.getErrorMessage()))
+        self.useLocalBoard()
+
+    def useLocalBoard(self):
+        """ Holds the chess board in this process, its tasks running in threads. """
+        self.shards = None
+        self.chessBoard = ChessBoard(memory_cap=HISTORY_MEMORY_CAP)
+        self.ponderStop = threading.Event()
+
+    def run(self, f, *args):
+        """
+        Runs a task on the chess board off the reactor, after the previous ones.
+        A running step of pondering stops to let it through.
+        :param f: Function of the task, taking the chess board and args.
+        :return: A Deferred firing with the result of the task.
+        """
+        if self.pondering:
+            self.playerTasks += 1
+            self.ponderStop.set()
+            return self.lock.run(self.startPlayerTask, f, *args)
+        return self.lock.run(self.dispatch, f, *args)
+
+    def startPlayerTask(self, f, *args):
+        self.playerTasks -= 1
+        return self.dispatch(f, *args)
+
+    def dispatch(self, f, *args):
+        """
+        Runs a task on the chess board in a thread, or in the worker process holding it.
+        :param f: Function of the task, taking the chess board and args.
+        :return: A Deferred firing with the result of the task.
+        """
+        if self.shards is None:
+            return deferToThread(f, self.chessBoard, *args)
+        return self.shards.run(self.game_id, f, *args)
+
     def move(self, x1, y1, x2, y2, color):
-        piece = self.chessBoard.grid[x1][y1]
-        if piece is not None and piece.color is not color:
-            raise IllegalMove("Trying to move a place that does not belong to the player.")
-        self.chessBoard.move(x1, y1, x2, y2, disp=False)
-        self.lightBoard.move(x1, y1, x2, y2)
-        self.validMovesCounter += 1
+        """
+        Performs a move off the reactor.
+        :return: A Deferred firing with the move, or failing with IllegalMove.
+        """
+        d = self.run(move_task, (x1, y1, x2, y2), color)
+        d.addCallback(self.moveDone)
+        return d
 
-    def autoMove(self):
-        return self.chessBoard.auto_move()
+    def autoMove(self, color, budget=None):
+        """
+        Chooses and performs a move off the reactor.
+        :param budget: Search budget of the move, as in ChessBoard.auto_move.
+        :return: A Deferred firing with the move, or failing with IllegalMove.
+        """
+        d = self.run(move_task, None, color, budget)
+        d.addCallback(self.moveDone)
+        return d
+
+    def moveDone(self, move):
+        self.lightBoard.move(*move)
+        for sentBoard in self.sentBoards.values():
+            sentBoard.move(*move)
+        self.validMovesCounter += 1
+        return move
 
     def checkEnd(self, color):
-        outcome = self.chessBoard.end_game()
+        d = self.run(end_game_task)
+        d.addCallback(self.sendOutcome, color)
+        return d
+
+    def sendOutcome(self, outcome, color):
         msg = {"type": "chat", "content": outcome}
         self.sendMessageTo(msg, color)
 
-    def updateLightBoardTask(self):
-        for col in [0, 1]:
-            for i, piece in enumerate(self.chessBoard.pieces[col]):
-                if piece is not None:
-                    color = piece.color
-                    position = piece.position
-                    natures = self.chessBoard.all_legal_natures(piece)
-                    pieceIndex = i + col * 24
-                    self.lightBoard.setPiece(pieceIndex, color, position, natures)
-        msg = {"type": "lightboard", "description": self.lightBoard.wrapUp()}
-        self.sendMessageToAll(msg)
+    def updateLightBoardTask(self, refresh):
+        """
+        Computes the pieces of the light board, unless the refresh is stale.
+        :param refresh: Number of the refresh.
+        :return: A Deferred firing with a list of (pieceIndex, color, position, natures), or None.
+        """
+        if refresh != self.refreshes:
+            return succeed(None)
+        return self.dispatch(pieces_task)
+
+    def sendLightBoard(self, pieces, refresh):
+        if pieces is None or refresh != self.refreshes:
+            return
+        for (pieceIndex, color, position, natures) in pieces:
+            self.lightBoard.setPiece(pieceIndex, color, position, natures)
+        self.lightBoard.version += 1
+        self.sendDelta(0)
+        self.sendDelta(1)
+
+    def sendDelta(self, color):
+        """
+        Sends the pieces of the light board that changed for a player.
+        :param color: Color of the player.
+        """
+        sentBoard = self.sentBoards[color]
+        msg = {
+            "type": "lightboard-delta",
+            "base": sentBoard.version,
+            "version": self.lightBoard.version,
+            "description": self.lightBoard.delta(sentBoard)
+        }
+        self.sentBoards[color] = self.lightBoard.copy()
+        self.sendMessageTo(msg, color)
+
+    def sendSnapshot(self, color):
+        """
+        Sends the whole light board to a player.
+        :param color: Color of the player.
+        """
+        msg = {
+            "type": "lightboard",
+            "version": self.lightBoard.version,
+            "description": self.lightBoard.wrapUp()
+        }
+        self.sentBoards[color] = self.lightBoard.copy()
+        self.sendMessageTo(msg, color)
 
     def updateLightBoard(self):
-        """ Schedules an update board task. """
-        reactor.callLater(0.5, self.updateLightBoardTask)
+        """
+        Schedules an update board task, making the previous ones stale.
+        :return: A Deferred firing when the update is sent or skipped.
+        """
+        self.refreshes += 1
+        d = self.lock.run(self.updateLightBoardTask, self.refreshes)
+        d.addCallback(self.sendLightBoard, self.refreshes)
+        self.ponder(self.validMovesCounter)
+        return d
+
+    def ponder(self, counter, step=0):
+        """
+        Schedules a step of pondering, after the tasks already waiting.
+        Steps go on one after the other until a move makes them stale, a
+        step stopped by a player's task being run again after it.
+        :param counter: Number of moves played when the pondering started.
+        :param step: Number of the step.
+        """
+        if not self.pondering:
+            return
+        d = self.lock.run(self.ponderTask, counter, step)
+        d.addCallback(lambda following: following is not None and self.ponder(counter, following))
+
+    def ponderTask(self, counter, step):
+        """
+        Runs a step of pondering, unless a move or the end of the game made it stale.
+        :return: A Deferred firing with the next step, or None once done.
+        """
+        if self.over or counter != self.validMovesCounter:
+            return succeed(None)
+        if self.playerTasks:
+            # The step runs again after the players' tasks waiting behind it
+            return succeed(step)
+        # The tasks which stopped the previous step are done
+        self.ponderStop.clear()
+        return self.dispatch(
+            ponder_task, step, self.factory.autoMoveBudget({}), self.ponderStop
+        )
 
     def sendMessageToAll(self, msg):
-        self.white.sendMessage(msg)
-        self.black.sendMessage(msg)
+        self.sendMessageTo(msg, 0)
+        self.sendMessageTo(msg, 1)
+
+    def colorOf(self, player):
+        return 0 if player is self.white else 1
+
+    def playerLeft(self, player):
+        """
+        Gives a disconnected player the grace period to come back.
+        :param player: Protocol of the disconnected player.
+        """
+        if self.over or player not in (self.white, self.black):
+            return
+        color = self.colorOf(player)
+        self.sendMessageTo({"type": "chat", "content": "Other player disconnected"}, 1 - color)
+        self.absent[color] = reactor.callLater(self.factory.gracePeriod, self.end)
+
+    def reattach(self, player, color):
+        """
+        Gives the game back to a player coming back in the grace period.
+        :param player: New protocol of the player.
+        :param color: Color of the player.
+        """
+        self.absent.pop(color).cancel()
+        player.game_id = self.game_id
+        player.game = self
+        player.color = color
+        player.state = "PLAYING"
+        if color == 0:
+            self.white = player
+        else:
+            self.black = player
+        self.sendMessageTo({"type": "chat", "content": "Other player reconnected"}, 1 - color)
+        msg = {
+            "type": "status",
+            "status": "resumed",
+            "resume_token": player.token,
+            "turn": self.validMovesCounter % 2
+        }
+        self.sendMessageTo(msg, color)
+        self.sendSnapshot(color)
+
+    def end(self):
+        """ Disconnects the players left and removes the game. """
+        self.over = True
+        for call in self.absent.values():
+            if call.active():
+                call.cancel()
+        self.absent = {}
+        for player in (self.white, self.black):
+            self.factory.sessions.pop(player.token, None)
+        if self.shards is not None:
+            self.shards.close(self.game_id)
+        self.disconnectPlayers()
+        self.factory.removeGame(self.game_id)
 
     def sendMessageTo(self, msg, color):
+        if color in self.absent:
+            return
         if color == 0:
             self.white.sendMessage(msg)
         elif color == 1:
@@ -309,6 +595,11 @@ if __name__ == '__main__':
     else:
         host, port = address.split(":")
 
+    # Number of worker processes holding the boards, none by default
+    shards = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    # Idle games prepare the moves of the player in turn with "ponder"
+    ponder = "ponder" in sys.argv[2:]
+
     endpoint = TCP4ServerEndpoint(reactor, int(port))
-    endpoint.listen(ChessServer())
+    endpoint.listen(ChessServer(shards=shards, ponder=ponder))
     reactor.run()
@@ -0,0 +1,227 @@
+"""Chess boards of the server games spread over worker processes."""
+
+import mmap
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail
+from twisted.python.failure import Failure
+
+from chess import ChessBoard, IllegalMove
+
+# Boards of the games of a worker process, by game identifier
+boards = {}
+
+# Stop flags of the game slots, one byte each in a file mapped by every
+# process, by path of the file
+flag_maps = {}
+
+# Games a worker process holds at most
+WORKER_SLOTS = 1024
+
+# Pseudo-legal moves tested by a step of pondering
+PONDER_CHUNK = 16
+
+
+def move_task(board, move, color, budget=None):
+    """
+    Perform a move of a player, chosen by the board within the search
+    budget if move is None.
+    """
+    if move is None:
+        move = board.auto_move(**(budget or {}))
+    x1, y1, x2, y2 = move
+    piece = board.grid[x1][y1]
+    if piece is not None and piece.color is not color:
+        raise IllegalMove("Trying to move a place that does not belong to the player.")
+    board.move(x1, y1, x2, y2, disp=False)
+    return (x1, y1, x2, y2)
+
+
+def end_game_task(board):
+    """Tell whether the game ended and how."""
+    return board.end_game()
+
+
+def pieces_task(board):
+    """List the (pieceIndex, color, position, natures) of the light board."""
+    legal_natures = board.legal_natures_all_pieces()
+    pieces = []
+    for col in [0, 1]:
+        for i, piece in enumerate(board.pieces[col]):
+            if piece is not None:
+                pieces.append(
+                    (i + col * 24, piece.color, piece.position,
+                     legal_natures[col][i])
+                )
+    return pieces
+
+
+def ponder_task(board, step, budget, stop):
+    """
+    Run a step of pondering for the player in turn, returning the next step,
+    the same one if stop was set before it completed, or None once done.
+
+    The first steps test the pseudo-legal moves a chunk at a time, filling
+    the feasibility cache, and the last one searches the auto-move within
+    the budget, kept by the board for an auto-move of the same budget.
+    """
+    moves = board.pseudo_legal_moves()
+    chunk = moves[step * PONDER_CHUNK:(step + 1) * PONDER_CHUNK]
+    if chunk:
+        for (x1, y1, x2, y2) in chunk:
+            if stop.is_set():
+                return step
+            try:
+                board.test_move(x1, y1, x2, y2)
+            except IllegalMove:
+                pass
+        return step + 1
+    board.sampled_move_suggestions(budget, stop=stop)
+    return step if stop.is_set() else None
+
+
+def open_board(game_id, memory_cap):
+    """Start the board of a game in the worker."""
+    boards[game_id] = ChessBoard(memory_cap=memory_cap)
+
+
+def close_board(game_id):
+    """Forget the board of a game in the worker."""
+    boards.pop(game_id, None)
+
+
+def run_task(game_id, function, args):
+    """Run a task on the board of a game in the worker."""
+    return function(boards[game_id], *args)
+
+
+def map_flags(path):
+    """Map the file of the stop flags in this process, once."""
+    if path not in flag_maps:
+        with open(path, "r+b") as f:
+            flag_maps[path] = mmap.mmap(f.fileno(), 0)
+    return flag_maps[path]
+
+
+class SlotStop():
+    """
+    Stop flag of a game slot, set and cleared by the reactor and read by
+    the worker, both mapping the same file.
+    """
+
+    def __init__(self, path, slot):
+        self.path = path
+        self.slot = slot
+
+    def is_set(self):
+        return map_flags(self.path)[self.slot] != 0
+
+    def set(self):
+        map_flags(self.path)[self.slot] = 1
+
+    def clear(self):
+        map_flags(self.path)[self.slot] = 0
+
+
+class ShardPool():
+    """
+    Worker processes holding the chess boards of the server games.
+
+    Each worker is a pool of a single process, so that a game always runs
+    on the same replica and its tasks run in the order they are sent.
+    """
+
+    def __init__(self, workers, memory_cap=None):
+        """
+        Prepare the workers, started on first use.
+
+        :param workers: Number of worker processes.
+        :param memory_cap: Bytes of history each board keeps dense.
+        """
+        fd, self.flags = tempfile.mkstemp(prefix="shards-")
+        os.write(fd, bytes(workers * WORKER_SLOTS))
+        os.close(fd)
+        self.executors = [ProcessPoolExecutor(1) for _ in range(workers)]
+        # Futures not done yet, cancelled when the workers stop
+        self.pending = set()
+        self.memory_cap = memory_cap
+        self.free = [list(range(WORKER_SLOTS)) for _ in range(workers)]
+        self.shards = {}
+
+    def submit(self, shard, function, *args):
+        """Run a function in a worker, firing a Deferred in the reactor."""
+        d = Deferred()
+        future = self.executors[shard].submit(function, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(self.fire, d, future))
+        return d
+
+    def fire(self, d, future):
+        exception = future.exception()
+        if exception is not None:
+            d.errback(Failure(exception))
+        else:
+            d.callback(future.result())
+
+    def open(self, game_id):
+        """
+        Start the board of a game on the least loaded worker.
+
+        :return: A Deferred firing once the board is ready, or failing if
+            no worker has room left or the board could not start.
+        """
+        shard = max(range(len(self.free)), key=lambda s: len(self.free[s]))
+        if not self.free[shard]:
+            return fail(RuntimeError("No worker has room left for a game."))
+        self.shards[game_id] = (shard, self.free[shard].pop())
+        d = self.submit(shard, open_board, game_id, self.memory_cap)
+        d.addErrback(self.release, game_id)
+        return d
+
+    def release(self, failure, game_id):
+        """Free the slot of a game whose board could not start."""
+        if game_id in self.shards:
+            shard, slot = self.shards.pop(game_id)
+            self.free[shard].append(slot)
+        return failure
+
+    def run(self, game_id, function, *args):
+        """
+        Run a task on the board of a game.
+
+        :param function: Task, taking the board and args.
+        :return: A Deferred firing with the result of the task.
+        """
+        shard, _ = self.shards[game_id]
+        return self.submit(shard, run_task, game_id, function, args)
+
+    def stop(self, game_id):
+        """
+        Stop flag of the tasks of a game, set and cleared in the reactor
+        and passed to the tasks.
+        """
+        shard, slot = self.shards[game_id]
+        return SlotStop(self.flags, shard * WORKER_SLOTS + slot)
+
+    def close(self, game_id):
+        """Free the board of a game."""
+        self.stop(game_id).clear()
+        shard, slot = self.shards.pop(game_id)
+        self.free[shard].append(slot)
+        return self.submit(shard, close_board, game_id)
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        for future in list(self.pending):
+            future.cancel()
+        for executor in self.executors:
+            executor.shutdown()
+        flags = flag_maps.pop(self.flags, None)
+        if flags is not None:
+            flags.close()
+        os.remove(self.flags)
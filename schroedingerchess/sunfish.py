@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import random
 import re
 import sys
 import time
+from array import array
 from itertools import count
 from collections import OrderedDict, namedtuple
 
@@ -110,19 +112,64 @@ directions = {
 MATE_LOWER = piece['K'] - 10*piece['Q']
 MATE_UPPER = piece['K'] + 10*piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The table size is the number of slots of the transposition tables, a power
+# of two. Each slot takes 20 bytes in the score table and 12 in the move table.
+TABLE_SIZE = 1 << 16
 
 # Constants for tuning search
 QS_LIMIT = 150
 EVAL_ROUGHNESS = 20
 
+# Nodes searched between two checks of the budget of a search
+CHECK_INTERVAL = 1024
+
+
+###############################################################################
+# Zobrist hashing
+###############################################################################
+
+# Random 64 bits keys of each piece on each square, of the castling rights, of
+# the en passant and king passant squares, and of the searched depths
+zobrist_random = random.Random(0)
+zobrist = {p: [zobrist_random.getrandbits(64) for i in range(120)]
+           for p in 'PNBRQKpnbrqk'}
+# Key of a piece on the rotated board
+zobrist_rotated = {p: [zobrist[p.swapcase()][119-i] for i in range(120)]
+                   for p in zobrist}
+zobrist_castling = [zobrist_random.getrandbits(64) for i in range(16)]
+zobrist_ep = [0] + [zobrist_random.getrandbits(64) for i in range(1, 120)]
+zobrist_kp = [0] + [zobrist_random.getrandbits(64) for i in range(1, 120)]
+zobrist_depth = [zobrist_random.getrandbits(64) for i in range(1000)]
+zobrist_root = zobrist_random.getrandbits(64)
+
+
+def board_hashes(board):
+    """ Zobrist hashes of a board and of the rotated board """
+    h = hr = 0
+    for i, p in enumerate(board):
+        if p in zobrist:
+            h ^= zobrist[p][i]
+            hr ^= zobrist_rotated[p][i]
+    return h, hr
+
+
+def board_score(board):
+    """ Evaluation of a board for the side to move, as kept by Position.move,
+    so that the stored bounds of a position hold whatever the root """
+    score = 0
+    for i, p in enumerate(board):
+        if p.isupper():
+            score += pst[p][i]
+        elif p.islower():
+            score -= pst[p.upper()][119-i]
+    return score
+
 
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+class Position(namedtuple('Position', 'board score wc bc ep kp hashes')):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -130,8 +177,22 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    hashes - the Zobrist hashes of the board and of the rotated board,
+        computed from the board if not given
     """
 
+    def __new__(cls, board, score, wc, bc, ep, kp, hashes=None):
+        if hashes is None:
+            hashes = board_hashes(board)
+        return super(Position, cls).__new__(cls, board, score, wc, bc, ep, kp, hashes)
+
+    def key(self):
+        """ Zobrist key of the position """
+        wc0, wc1 = self.wc
+        bc0, bc1 = self.bc
+        return (self.hashes[0] ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp] ^
+                zobrist_castling[wc0 | wc1 << 1 | bc0 << 2 | bc1 << 3])
+
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
         # as defined in the 'directions' map. The rays are broken e.g. by
@@ -168,18 +229,30 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            self.hashes[::-1])
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0)
+            self.bc, self.wc, 0, 0, self.hashes[::-1])
 
     def move(self, move):
         i, j = move
         p, q = self.board[i], self.board[j]
-        def put(board, i, p): return board[:i] + p + board[i+1:]
+        h, hr = self.hashes
+        def put(board, i, p):
+            # Update the hashes along with the board
+            nonlocal h, hr
+            old = board[i]
+            if old != '.':
+                h ^= zobrist[old][i]
+                hr ^= zobrist_rotated[old][i]
+            if p != '.':
+                h ^= zobrist[p][i]
+                hr ^= zobrist_rotated[p][i]
+            return board[:i] + p + board[i+1:]
         # Copy variables and reset ep and kp
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
@@ -212,7 +285,7 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
             if j == self.ep:
                 board = put(board, j+S, '.')
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate()
+        return Position(board, score, wc, bc, ep, kp, (h, hr)).rotate()
 
     def value(self, move):
         i, j = move
@@ -245,44 +318,110 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
 
-# The normal OrderedDict doesn't update the position of a key in the list,
-# when the value is changed.
 
+class ScoreTable:
+    '''Fixed-size table of the score bounds of (pos, depth, root) keys.
 
-class LRUCache:
-    '''Store items in the order the keys were last added'''
+    Each key goes to the slot given by the low bits of its Zobrist key, the
+    whole key being kept to tell collisions apart. An entry of the current
+    search only gives its slot up to entries searched at least as deep, while
+    entries of previous searches are always replaced.'''
 
     def __init__(self, size):
-        self.od = OrderedDict()
-        self.size = size
+        self.mask = size - 1
+        self.keys = array('Q', bytes(8 * size))
+        self.ages = array('H', bytes(2 * size))
+        self.depths = array('H', bytes(2 * size))
+        self.lowers = array('i', bytes(4 * size))
+        self.uppers = array('i', bytes(4 * size))
+        # Age of the entries of the current search, 0 marking empty slots
+        self.age = 1
+
+    def new_search(self):
+        self.age = self.age % 0xffff + 1
 
     def get(self, key, default=None):
-        try:
-            self.od.move_to_end(key)
-        except KeyError:
+        pos, depth, root = key
+        key = pos.key() ^ zobrist_depth[depth] ^ (zobrist_root if root else 0)
+        k = key & self.mask
+        if self.keys[k] != key or not self.ages[k]:
             return default
-        return self.od[key]
+        return Entry(self.lowers[k], self.uppers[k])
 
-    def __setitem__(self, key, value):
-        try:
-            del self.od[key]
-        except KeyError:
-            if len(self.od) == self.size:
-                self.od.popitem(last=False)
-        self.od[key] = value
+    def __setitem__(self, key, entry):
+        pos, depth, root = key
+        key = pos.key() ^ zobrist_depth[depth] ^ (zobrist_root if root else 0)
+        k = key & self.mask
+        if self.ages[k] == self.age and self.keys[k] != key and self.depths[k] > depth:
+            return
+        self.keys[k] = key
+        self.ages[k] = self.age
+        self.depths[k] = depth
+        self.lowers[k] = entry.lower
+        self.uppers[k] = entry.upper
+
+
+class MoveTable:
+    '''Fixed-size table of the best move of each position, always replaced'''
+
+    def __init__(self, size):
+        self.mask = size - 1
+        self.keys = array('Q', bytes(8 * size))
+        self.moves = array('i', [-1]) * size
+
+    def get(self, pos, default=None):
+        key = pos.key()
+        k = key & self.mask
+        if self.keys[k] != key or self.moves[k] < 0:
+            return default
+        return divmod(self.moves[k], 120)
+
+    def __setitem__(self, pos, move):
+        key = pos.key()
+        k = key & self.mask
+        self.keys[k] = key
+        self.moves[k] = -1 if move is None else 120 * move[0] + move[1]
+
+
+class SearchAborted(Exception):
+    '''The node budget or the hard deadline of a search is exhausted'''
+    pass
 
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = LRUCache(TABLE_SIZE)
-        self.tp_move = LRUCache(TABLE_SIZE)
+    def __init__(self, table_size=TABLE_SIZE):
+        # The tables outlive the searches, so that a search reuses the work of
+        # the previous ones
+        self.tp_score = ScoreTable(table_size)
+        self.tp_move = MoveTable(table_size)
         self.nodes = 0
+        self.depth = 0
+        # Budget of the current search, and node count of its next check
+        self.max_nodes = None
+        self.deadline = None
+        self.stop = None
+        self.next_check = 0
+
+    def check(self):
+        """ Abort the search once its node budget or hard deadline is
+        exhausted, even within the first depth, or if it is asked to stop """
+        if self.stop is not None and self.stop.is_set():
+            raise SearchAborted()
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise SearchAborted()
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchAborted()
+        self.next_check = self.nodes + CHECK_INTERVAL
+        if self.max_nodes is not None and self.max_nodes > self.nodes:
+            self.next_check = min(self.next_check, self.max_nodes)
 
     def bound(self, pos, gamma, depth, root=True):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for calmness, and so there is no reason to keep different depths in the transposition table.
         depth = max(depth, 0)
@@ -363,6 +502,7 @@ class Searcher:
     def _search(self, pos):
         """ Iterative deepening MTD-bi search """
         self.nodes = 0
+        self.tp_score.new_search()
 
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
@@ -386,14 +526,35 @@ class Searcher:
             # Yield so the user may inspect the search
             yield
 
-    def search(self, pos, secs):
+    def search(self, pos, secs=None, nodes=None, depth=None, hard=None, stop=None):
+        """ Search the best move of pos and its score within a budget
+        secs -- soft deadline in seconds, after which no depth is started
+        nodes -- number of nodes after which the search is aborted
+        depth -- deepest iteration
+        hard -- hard deadline in seconds, after which the search is aborted
+        stop -- flag whose is_set method tells when to abort the search
+        An aborted search returns the result of the last completed depth, or
+        (None, None) if the first one was not completed. """
+        if secs is None and nodes is None and depth is None and hard is None:
+            raise ValueError("The search needs a budget")
         start = time.time()
-        for _ in self._search(pos):
-            if time.time() - start > secs:
-                break
-        # If the game hasn't finished we can retrieve our move from the
-        # transposition table.
-        return self.tp_move.get(pos), self.tp_score.get((pos, self.depth, True)).lower
+        self.max_nodes = nodes
+        self.deadline = None if hard is None else start + hard
+        self.stop = stop
+        self.next_check = 0
+        result = None, None
+        try:
+            for _ in self._search(pos):
+                # If the game hasn't finished we can retrieve our move from the
+                # transposition table.
+                result = self.tp_move.get(pos), self.tp_score.get((pos, self.depth, True)).lower
+                if secs is not None and time.time() - start > secs:
+                    break
+                if depth is not None and self.depth >= depth:
+                    break
+        except SearchAborted:
+            pass
+        return result
 
 
 ###############################################################################
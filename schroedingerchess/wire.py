@@ -0,0 +1,191 @@
+"""Encodings of the messages exchanged by the server and the clients."""
+
+import json
+import struct
+import time
+
+# Natures of the light board pieces, "E" standing for an unknown nature
+natures = ["K", "Q", "R", "B", "N", "P", "E"]
+
+# Position bytes of the pieces not on the board yet, or already taken
+not_placed = 64
+taken = 65
+
+# Color byte of the messages that have none
+no_color = 255
+
+# First byte of the binary messages, JSON messages starting with "{"
+codes = {
+    "move": 1,
+    "automove": 2,
+    "endgame": 3,
+    "lightboard-request": 4,
+    "lightboard": 5,
+    "lightboard-delta": 6
+}
+types = {code: t for (t, code) in codes.items()}
+
+# Bit of each nature, and natures of each mask
+nature_bits = {n: 1 << b for (b, n) in enumerate(natures)}
+mask_natures = [
+    [n for (b, n) in enumerate(natures) if mask & (1 << b)]
+    for mask in range(1 << len(natures))
+]
+
+
+def encode_piece(piece):
+    """Pack a light board piece into a position byte and a nature byte."""
+    position = piece["position"]
+    if position is None:
+        square = not_placed
+    elif position is False:
+        square = taken
+    else:
+        square = 8 * position[0] + position[1]
+    mask = 0
+    for n in piece["natures"]:
+        mask |= nature_bits[n]
+    return bytes([square, piece["color"] << 7 | mask])
+
+
+def decode_piece(data, k):
+    """Unpack the light board piece starting at byte k."""
+    square, byte = data[k], data[k + 1]
+    if square == not_placed:
+        position = None
+    elif square == taken:
+        position = False
+    else:
+        position = [square >> 3, square & 7]
+    return {
+        "position": position,
+        "color": byte >> 7,
+        "natures": mask_natures[byte & 127][:]
+    }
+
+
+def encode_binary(msg):
+    """Pack a message whose type has a binary form."""
+    t = msg["type"]
+    data = bytes([codes[t]])
+    if t in ["move", "automove", "endgame"]:
+        color = msg.get("color")
+        data += bytes([no_color if color is None else color])
+    if t == "move":
+        x1, y1, x2, y2 = msg["description"]
+        data += struct.pack("!H", x1 << 12 | y1 << 8 | x2 << 4 | y2)
+    elif t == "automove" and "budget" in msg:
+        # Nodes, depth and deadlines in milliseconds, 0 standing for none
+        budget = msg["budget"]
+        data += struct.pack(
+            "!IHII", budget.get("nodes") or 0, budget.get("depth") or 0,
+            round(1000 * (budget.get("secs") or 0)),
+            round(1000 * (budget.get("hard") or 0))
+        )
+    elif t == "lightboard":
+        data += struct.pack("!I", msg["version"])
+        data += b"".join(map(encode_piece, msg["description"]))
+    elif t == "lightboard-delta":
+        data += struct.pack("!II", msg["base"], msg["version"])
+        data += b"".join(
+            bytes([i]) + encode_piece(piece)
+            for i, piece in msg["description"]
+        )
+    return data
+
+
+def decode_binary(data):
+    """Unpack a message from its binary form."""
+    t = types[data[0]]
+    msg = {"type": t}
+    if t in ["move", "automove", "endgame"]:
+        if data[1] != no_color:
+            msg["color"] = data[1]
+    if t == "move":
+        nibbles, = struct.unpack("!H", data[2:4])
+        msg["description"] = [
+            nibbles >> 12, nibbles >> 8 & 15, nibbles >> 4 & 15, nibbles & 15
+        ]
+    elif t == "automove" and len(data) > 2:
+        nodes, depth, secs, hard = struct.unpack("!IHII", data[2:16])
+        msg["budget"] = {
+            key: value for (key, value) in [
+                ("nodes", nodes), ("depth", depth),
+                ("secs", secs / 1000), ("hard", hard / 1000)
+            ] if value
+        }
+    elif t == "lightboard":
+        msg["version"], = struct.unpack("!I", data[1:5])
+        msg["description"] = [
+            decode_piece(data, k) for k in range(5, len(data), 2)
+        ]
+    elif t == "lightboard-delta":
+        msg["base"], msg["version"] = struct.unpack("!II", data[1:9])
+        msg["description"] = [
+            [data[k], decode_piece(data, k + 1)]
+            for k in range(9, len(data), 3)
+        ]
+    return msg
+
+
+def encode(msg, binary=False):
+    """
+    Encode a message in the binary format if asked and possible, else JSON.
+    :param msg: A dictionary representing a message.
+    :param binary: Whether the receiver accepts the binary format.
+    """
+    if binary and msg["type"] in codes:
+        return encode_binary(msg)
+    return json.dumps(msg).encode()
+
+
+def decode(data):
+    """
+    Decode a message in either format.
+    :param data: Bytes of a message.
+    """
+    if data[:1] == b"{":
+        return json.loads(data.decode())
+    return decode_binary(data)
+
+
+def benchmark(repeat=1000):
+    """Measure bytes and encoding times of typical messages in both formats."""
+    from chess import LightBoard
+    board = LightBoard()
+    board.version = 12
+    board.move(4, 1, 4, 3)
+    messages = {
+        "move": {"type": "move", "color": 0, "description": [4, 1, 4, 3]},
+        "lightboard": {
+            "type": "lightboard", "version": 12,
+            "description": board.wrapUp()
+        },
+        "lightboard-delta": {
+            "type": "lightboard-delta", "base": 11, "version": 12,
+            "description": board.delta(LightBoard())
+        }
+    }
+    results = {}
+    for t, msg in messages.items():
+        for binary in [False, True]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                data = encode(msg, binary)
+            encoding = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                decode(data)
+            decoding = (time.perf_counter() - start) / repeat
+            results[(t, "binary" if binary else "json")] = (
+                len(data), encoding, decoding
+            )
+    return results
+
+
+if __name__ == "__main__":
+    print("{:<18} {:<7} {:>6} {:>12} {:>12}".format(
+        "message", "format", "bytes", "encode (us)", "decode (us)"))
+    for (t, fmt), (size, encoding, decoding) in benchmark().items():
+        print("{:<18} {:<7} {:>6} {:>12.1f} {:>12.1f}".format(
+            t, fmt, size, 1e6 * encoding, 1e6 * decoding))